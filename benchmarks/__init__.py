@@ -0,0 +1,3 @@
+"""
+    Benchmarks of the scraping, building and serving paths, run from the repository root
+"""
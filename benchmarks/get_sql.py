@@ -0,0 +1,83 @@
+"""
+    Measures the latency of DatabaseManager.get_sql on a dense week
+
+    python -m benchmarks.get_sql [--groups N] [--events-per-day N] [--requests N] [--check-plan]
+
+    With --check-plan, exits with an error if the query of get_sql scans a table
+    instead of using the indexes.
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import databasemanager
+import hyperapi
+from benchmarks import synthetic
+
+
+def populate(manager: databasemanager.DatabaseManager, groups: int, weeks: int,
+             events_per_day: int):
+    """
+        Fills the database with synthetic calendars, without any download
+    :param manager: The DatabaseManager of the database
+    :param groups: The number of school classes, named G0, G1...
+    :param weeks: The number of weeks of each calendar
+    :param events_per_day: The number of events per weekday
+    :return:
+        None
+    """
+    connection = sqlite3.connect(manager.database)
+    batch = databasemanager.Batch(connection.cursor())
+    for index in range(groups):
+        name = "G{}".format(index)
+        manager.sync_class(name, hyperapi.parse(
+            synthetic.calendar(name, weeks, events_per_day, seed=index)), batch)
+    batch.write()
+    connection.commit()
+    connection.close()
+
+
+def main():
+    """
+        Runs the benchmark and prints the latency statistics
+    :return:
+        None
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--weeks", type=int, default=20)
+    parser.add_argument("--events-per-day", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--check-plan", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        manager = databasemanager.DatabaseManager(os.path.join(directory, "plannings.db"))
+        populate(manager, args.groups, args.weeks, args.events_per_day)
+
+        if args.check_plan:
+            connection = sqlite3.connect(manager.database)
+            offending = databasemanager.explain(
+                connection, databasemanager.SESSIONS_QUERY,
+                ("G0",) + databasemanager.get_bounds(week="2020-W03"))
+            connection.close()
+            if offending:
+                sys.exit("get_sql query plan degraded : " + ", ".join(offending))
+
+        latencies = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            manager.get_sql("G0", week="2020-W03")
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    print("get_sql week, {} lessons/day : median {:.3f} ms, p95 {:.3f} ms, mean {:.3f} ms".format(
+        args.events_per_day, statistics.median(latencies),
+        latencies[int(len(latencies) * 0.95)], statistics.mean(latencies)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+    Measures the parsing throughput of hyperapi on a large synthetic calendar
+
+    python -m benchmarks.parse [--weeks N] [--events-per-day N] [--repeat N]
+"""
+import argparse
+import time
+from icalendar import Calendar
+import hyperapi
+from benchmarks import synthetic
+
+
+def measure(function, repeat: int):
+    """
+        Times the fastest of several runs of a function
+    :param function: The function, called without arguments
+    :param repeat: The number of runs
+    :return:
+        The duration of the fastest run, in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    """
+        Runs the benchmark and prints the throughput of each parsing stage
+    :return:
+        None
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--weeks", type=int, default=80)
+    parser.add_argument("--events-per-day", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = synthetic.calendar("G0", args.weeks, args.events_per_day, teachers=3, rooms=3)
+    events = [component for component in Calendar.from_ical(text).walk()
+              if component.name == "VEVENT"]
+
+    for name, function in (
+            ("event_filter", lambda: [hyperapi.event_filter(event) for event in events]),
+            ("parse", lambda: hyperapi.parse(text)),
+            ("parse_lines", lambda: list(hyperapi.parse_lines(text.splitlines())))):
+        duration = measure(function, args.repeat)
+        print("{:<12} {:>9.0f} events/s ({} events in {:.3f} s)".format(
+            name, len(events) / duration, len(events), duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+    Serves synthetic .ical files the way HyperPlanning does, to refresh the database
+    without reaching the real server
+
+    python -m benchmarks.server [--port N] [--groups N] [--weeks N] [--events-per-day N]
+                                [--latency SECONDS]
+
+    Point the url of the [hyperplanning] section to http://127.0.0.1:<port>/ and list
+    the classes G0:0, G1:1... in config/calendars.config.
+"""
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+from benchmarks import synthetic
+
+
+def serve(calendars: dict, port: int = 0, latency: float = 0.0):
+    """
+        Serves .ical files in a background thread, by their idICal parameter.
+        Responses carry an ETag and unchanged calendars are answered with a 304.
+    :param calendars: The contents of the .ical files, by idICal
+    :param port: The port to listen on, 0 for any free port
+    :param latency: The delay before each response, in seconds
+    :return:
+        The ThreadingHTTPServer, whose server_port is the port listened on
+    """
+    bodies = {ical: text.encode() for ical, text in calendars.items()}
+    etags = {ical: '"{}"'.format(hashlib.sha1(body).hexdigest()) for ical, body in bodies.items()}
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+            Answers the .ical file downloads
+        """
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            """
+                Sends the .ical file of the idICal parameter
+            :return:
+                None
+            """
+            ical = parse_qs(urlparse(self.path).query).get("idICal", [None])[0]
+            time.sleep(latency)
+            if ical not in bodies:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif self.headers.get("If-None-Match") == etags[ical]:
+                self.send_response(304)
+                self.send_header("ETag", etags[ical])
+                self.end_headers()
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/calendar; charset=utf-8")
+                self.send_header("Content-Length", str(len(bodies[ical])))
+                self.send_header("ETag", etags[ical])
+                self.end_headers()
+                self.wfile.write(bodies[ical])
+
+        def log_message(self, *args):
+            """
+                Keeps the benchmark output clean
+            :return:
+                None
+            """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    """
+        Serves synthetic calendars until interrupted
+    :return:
+        None
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--weeks", type=int, default=20)
+    parser.add_argument("--events-per-day", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = serve({str(index): synthetic.calendar("G{}".format(index), args.weeks,
+                                                   args.events_per_day, seed=index)
+                    for index in range(args.groups)}, args.port, args.latency)
+    print("Serving {} calendars on http://127.0.0.1:{}/".format(args.groups, server.server_port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
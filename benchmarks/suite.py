@@ -0,0 +1,249 @@
+"""
+    Measures the whole pipeline on synthetic calendars served by a local HyperPlanning
+    stand-in : download, parsing, database build and API requests. Prints the results
+    as JSON, to compare them between versions.
+
+    python -m benchmarks.suite [--groups N] [--weeks N] [--events-per-day N] [--shared N]
+                               [--teachers N] [--rooms N] [--latency SECONDS]
+                               [--requests N] [--threads N] [--set SECTION.OPTION=VALUE]...
+                               [--today YYYY-MM-DD] [--label LABEL] [--output FILE]
+
+    The configuration is the one of config/database.config, changed by each --set.
+    The today requests are answered as on --today, a weekday of the synthetic calendars.
+"""
+import argparse
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+import importlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import databasemanager
+import hyperapi
+from benchmarks import server, synthetic
+
+
+def percentile(values: list, fraction: float):
+    """
+        Reads a percentile of sorted values
+    :param values: The sorted values
+    :param fraction: The fraction of the values below the percentile
+    :return:
+        float
+    """
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def timed(function):
+    """
+        Runs a function once
+    :param function: The function, called without arguments
+    :return:
+        A (result, duration in seconds) tuple
+    """
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def frozen(day: datetime):
+    """
+        Creates a datetime class whose current time is noon of a given day
+    :param day: The day
+    :return:
+        A subclass of datetime
+    """
+    class Frozen(datetime):
+        """
+            A datetime whose now() is fixed
+        """
+
+        @classmethod
+        def now(cls, tz=None):
+            """
+                Gives noon of the frozen day
+            :param tz: Unused, the times of the API are naive
+            :return:
+                Frozen
+            """
+            return cls(day.year, day.month, day.day, 12)
+
+    return Frozen
+
+
+def load(app, paths: list, threads: int):
+    """
+        Requests paths of the API from several threads
+    :param app: The Flask application
+    :param paths: The paths to request, shared between the threads
+    :param threads: The number of threads
+    :return:
+        A dict of the request count, the number of empty timetables, the throughput
+        and the latency percentiles
+    """
+    latencies = []
+    empty = []
+    lock = threading.Lock()
+
+    def run(share: list):
+        client = app.test_client()
+        measured = []
+        count = 0
+        for path in share:
+            start = time.perf_counter()
+            response = client.get(path)
+            data = response.get_data()
+            measured.append(time.perf_counter() - start)
+            count += data.strip() == b"[]"
+        with lock:
+            latencies.extend(measured)
+            empty.append(count)
+
+    workers = [threading.Thread(target=run, args=(paths[index::threads],))
+               for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "empty": sum(empty),
+        "throughput": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p90_ms": percentile(latencies, 0.9) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def main():
+    """
+        Runs the benchmark and prints its results as JSON
+    :return:
+        None
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--weeks", type=int, default=20)
+    parser.add_argument("--events-per-day", type=int, default=6)
+    parser.add_argument("--shared", type=int, default=1)
+    parser.add_argument("--teachers", type=int, default=2)
+    parser.add_argument("--rooms", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--today", default=(synthetic.FIRST_MONDAY + timedelta(days=9))
+                        .strftime("%Y-%m-%d"))
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.OPTION=VALUE")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    calendars = {str(index): synthetic.calendar(
+        "G{}".format(index), args.weeks, args.events_per_day, args.shared,
+        args.teachers, args.rooms, seed=index) for index in range(args.groups)}
+    stand_in = server.serve(calendars, latency=args.latency)
+
+    config = ConfigParser()
+    config.read('config/database.config')
+    config.set('planning', 'path', 'databases/plannings.db')
+    config.set('hyperplanning', 'url', 'http://127.0.0.1:{}/'.format(stand_in.server_port))
+    if not config.has_section('server'):
+        config.add_section('server')
+    config.set('server', 'refresh', 'no')
+    for setting in args.set:
+        option, value = setting.split("=", 1)
+        config.set(*option.split(".", 1), value)
+
+    results = {
+        "label": args.label,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "parameters": {key: value for key, value in vars(args).items()
+                       if key not in ("label", "output")},
+        "config": {section: dict(config[section]) for section in config.sections()},
+        "calendars": {"groups": args.groups,
+                      "bytes": sum(len(text.encode()) for text in calendars.values())},
+    }
+
+    directory = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    try:
+        # The API reads its configuration from the working directory
+        os.chdir(directory.name)
+        for folder in ('config', 'logs', 'databases'):
+            os.makedirs(folder)
+        with open('config/calendars.config', 'w') as file:
+            file.writelines("G{0}:{0}\n".format(index) for index in range(args.groups))
+        with open('config/database.config', 'w') as file:
+            config.write(file)
+        manager = databasemanager.from_config(config, serving=False)
+        urls = [school_class.url for school_class in manager.classes]
+
+        texts, duration = timed(lambda: [text for _, text, _ in hyperapi.fetch_calendars(
+            urls, manager.workers, session=manager.session)])
+        results["download"] = {"seconds": duration}
+        count, duration = timed(lambda: sum(
+            1 for text in texts for _ in hyperapi.parse_lines(text.splitlines())))
+        results["calendars"]["events"] = count
+        results["parse"] = {"seconds": duration, "events_per_second": count / duration}
+        _, duration = timed(lambda: [hyperapi.scrape(url, session=manager.session)
+                                     for url in urls])
+        results["scrape"] = {"seconds": duration}
+        _, duration = timed(manager.build)
+        results["build"] = {"seconds": duration}
+        _, duration = timed(manager.build)
+        results["rebuild"] = {"seconds": duration}
+
+        connection = sqlite3.connect(manager.database)
+        results["database"] = {
+            "bytes": sum(os.path.getsize(path) for path in
+                         (manager.database, manager.database + "-wal") if os.path.exists(path)),
+            "sessions": connection.execute('SELECT COUNT(*) FROM sessions;').fetchone()[0],
+        }
+        connection.close()
+
+        api = importlib.import_module("main")
+        # Requests are answered from memory once the timetable is loaded
+        api.DB.load()
+        # The synthetic calendars are in the past, /today is answered as on a day they cover
+        api.datetime = frozen(datetime.strptime(args.today, "%Y-%m-%d"))
+        rand = random.Random(0)
+        groups = ["G{}".format(rand.randrange(args.groups)) for _ in range(args.requests)]
+        days = [synthetic.FIRST_MONDAY + timedelta(days=rand.randrange(7 * args.weeks))
+                for _ in range(args.requests)]
+        results["requests"] = {
+            "today": load(api.APP, ["/api/s2/{}/today".format(group) for group in groups],
+                          args.threads),
+            "day": load(api.APP, ["/api/s2/{}/day/{}".format(group, day.strftime("%Y-%m-%d"))
+                                  for group, day in zip(groups, days)], args.threads),
+            "week": load(api.APP, ["/api/s2/{}/week/{}-W{:02d}".format(
+                group, *day.isocalendar()[:2]) for group, day in zip(groups, days)],
+                args.threads),
+        }
+        results["cache"] = {"hits": api.CACHE.hits, "misses": api.CACHE.misses}
+    finally:
+        os.chdir(cwd)
+        stand_in.shutdown()
+        directory.cleanup()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+    Generates synthetic HyperPlanning .ical files
+"""
+from datetime import datetime, timedelta
+import random
+
+FIRST_MONDAY = datetime(2020, 1, 6)
+# UTC start hours of the time slots of a day
+SLOTS = (6, 7.5, 9, 10.5, 12, 13.5, 15, 16.5, 18, 19.5)
+
+
+def calendar(group: str, weeks: int = 20, events_per_day: int = 4, shared: int = 1,
+             teachers: int = 2, rooms: int = 2, courses: int = 30, seed: int = 0):
+    """
+        Generates the .ical file of a school class
+    :param group: The name of the school class
+    :param weeks: The number of weeks, starting on FIRST_MONDAY
+    :param events_per_day: The number of events per weekday, at most len(SLOTS)
+    :param shared: The number of events per day shared by every school class,
+        with the same UID and content in every calendar
+    :param teachers: The maximum number of teachers of an event
+    :param rooms: The maximum number of rooms of an event
+    :param courses: The number of distinct courses
+    :param seed: The random seed of the class-specific events
+    :return:
+        str
+    """
+    rand = random.Random(seed)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//HyperAPI//Synthetic//FR"]
+    for week in range(weeks):
+        for day in range(5):
+            for slot in range(min(events_per_day, len(SLOTS))):
+                is_shared = slot < shared
+                # Shared events draw from a generator common to every school class
+                event_rand = random.Random(week * 1000 + day * 100 + slot) if is_shared else rand
+                start = FIRST_MONDAY + timedelta(weeks=week, days=day, hours=SLOTS[slot])
+                uid = ("Cours-{}-{}-{}".format(week, day, slot) if is_shared else
+                       "Cours-{}-{}-{}-{}".format(group, week, day, slot))
+                lines += event(uid, start, start + timedelta(minutes=90),
+                               "Promo" if is_shared else group,
+                               event_rand, teachers, rooms, courses)
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def event(uid: str, start: datetime, end: datetime, group: str, rand: random.Random,
+          teachers: int, rooms: int, courses: int):
+    """
+        Generates the lines of a VEVENT
+    :param uid: The UID of the event
+    :param start: The UTC start of the event
+    :param end: The UTC end of the event
+    :param group: The school class shown in the summary
+    :param rand: The random generator of the event content
+    :param teachers: The maximum number of teachers
+    :param rooms: The maximum number of rooms
+    :param courses: The number of distinct courses
+    :return:
+        A list of str
+    """
+    course = rand.randrange(courses)
+    kind = rand.choice(("Cours", "TD", "TP", "TP", "DS"))
+    names = ", ".join("{} Enseignant{}".format(rand.choice(("M.", "Mme")), rand.randrange(60))
+                      for _ in range(rand.randint(1, teachers)))
+    if kind == "DS":
+        summary = "M{} Matiere{} - {} - DS - Controle {} - {}".format(
+            3100 + course, course, names, course, group)
+    else:
+        summary = "M{} Matiere{} - {} - {} - {}".format(3100 + course, course, names, kind, group)
+    location = ",".join("{}{}".format(rand.choice("ABC"), rand.randrange(40))
+                        for _ in range(rand.randint(1, rooms)))
+    return ["BEGIN:VEVENT",
+            "UID:" + uid,
+            "DTSTAMP:20200101T000000Z",
+            "DTSTART:" + start.strftime("%Y%m%dT%H%M%SZ"),
+            "DTEND:" + end.strftime("%Y%m%dT%H%M%SZ"),
+            "SUMMARY:" + summary,
+            "LOCATION:" + location,
+            "END:VEVENT"]
@@ -0,0 +1,60 @@
+"""
+    Caches the encoded API responses between two database builds
+"""
+from collections import OrderedDict
+import threading
+
+
+class ResponseCache:
+    """
+        A bounded least recently used cache, emptied when the database generation changes
+    """
+
+    def __init__(self, size: int = 1024):
+        """
+            Initializes an empty cache
+        :param size: The maximum number of cached responses
+        """
+        self.size = size
+        self.generation = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, generation: int, key: tuple):
+        """
+            Retrieves a cached response
+        :param generation: The current generation of the database
+        :param key: The key of the response
+        :return:
+            The cached value, or None
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, generation: int, key: tuple, value):
+        """
+            Caches a response, evicting the least recently used one if the cache is full
+        :param generation: The generation of the database the response was built from
+        :param key: The key of the response
+        :param value: The value to cache
+        :return:
+            None
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
@@ -1,313 +1,1427 @@
 """
     Handles the .ical to database conversion.
 """
+import os
+import random
 import sqlite3
 import threading
+import time
 import datetime
+import urllib.request
 from collections import namedtuple
 import logging
+from configparser import ConfigParser
 import isoweek
 import hyperapi
 import json
+import metrics
+import pool
+import timetable
 
 LOGGER = logging.getLogger('root')
-LOGGER.addHandler(logging.FileHandler("logs/database.log", 'w'))
-Classe = namedtuple("Classe", ("nom", "url"), defaults=(None,))
+LOGGER.addHandler(metrics.queue_handler(logging.FileHandler("logs/database.log", 'a')))
+METRICS = metrics.METRICS
+METRICS.declare("hyperapi_refresh_seconds", "histogram",
+                "Duration of the refreshes of the database", metrics.DURATION_BUCKETS)
+METRICS.declare("hyperapi_refresh_stage_seconds", "histogram",
+                "Duration of each stage of the refreshes which update the database",
+                metrics.DURATION_BUCKETS)
+METRICS.declare("hyperapi_refresh_class_seconds", "gauge",
+                "Duration of the parsing, insertion, materialization and commit of the "
+                "calendar of each class during its last update")
+METRICS.declare("hyperapi_refreshes_total", "counter",
+                "Refreshes of the database, by result : updated, unchanged or failed")
+METRICS.declare("hyperapi_download_failures_total", "counter",
+                "Failed downloads of the calendar of each class")
+METRICS.declare("hyperapi_query_seconds", "histogram",
+                "Duration of the database queries of the requests", metrics.LATENCY_BUCKETS)
+Classe = namedtuple("Classe", ("nom", "url", "intervalle"), defaults=(None, None))
+HYPERPLANNING_URL = "https://hyperplanning.iut.u-bordeaux.fr/"
+# The delay before refreshing a calendar which failed once, doubled by each new failure
+BACKOFF_DELAY = 60.0
+# The time between two checks for a new generation to load in memory, without refresher
+WATCH_INTERVAL = 1.0
 
 
-def create_class(name: str, url: str):
+def create_class(name: str, url: str, base_url: str = HYPERPLANNING_URL,
+                 interval: float = None):
     """
         Creates an initialized Classe namedtuple
     :param name: The nomMatiere of the school class
     :param url: The URL of the appropriate .ical file
+    :param base_url: The HyperPlanning server serving the .ical files
+    :param interval: The time between two refreshes of the class, in seconds,
+        None for the default interval
     :return:
         An initialized Classe namedtuple object
     """
-    return Classe(name, "https://hyperplanning.iut.u-bordeaux.fr/" +
+    return Classe(name, base_url +
                   "Telechargements/ical/Edt_EXAMPLE.ics?" +
                   "version=2019.0.5.0&idICal={}&param=643d5b312e2e36325d2666683d3126663d31".format(
-                      url))
+                      url), interval)
 
 
-def parse_config():
+def parse_config(base_url: str = HYPERPLANNING_URL):
     """
         Parses the calendar config file
+    :param base_url: The HyperPlanning server serving the .ical files
     :return: A Classe list
     """
     school_class_list = []
     with open('config/calendars.config', 'r') as config:
         for line in config.readlines():
-            school_class = line.split(':')
+            school_class = line.replace('\n', '').split(':')
             school_class_list.append(create_class(school_class[0],
-                                                  school_class[1].replace('\n', '')))
+                                                  school_class[1],
+                                                  base_url,
+                                                  float(school_class[2])
+                                                  if len(school_class) > 2 else None))
     return school_class_list
 
 
+def migrate(connection: sqlite3.Connection):
+    """
+        Brings the schema of a database up to SCHEMA_VERSION
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    version = connection.execute('PRAGMA user_version;').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        migration(connection)
+        connection.execute('PRAGMA user_version = {};'.format(number))
+        connection.commit()
+
+
+def create_tables(connection: sqlite3.Connection):
+    """
+        Schema version 1 : creates the tables
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS ' +
+        'cours(idCours INTEGER PRIMARY KEY AUTOINCREMENT, ' +
+        'idMatiere TEXT NOT NULL, nomMatiere TEXT NOT NULL, ' +
+        'UNIQUE(idMatiere, nomMatiere));'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS ' +
+        'profs(idProf INTEGER PRIMARY KEY AUTOINCREMENT, ' +
+        'nomProf TEXT NOT NULL, UNIQUE(nomProf));'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS ' +
+        'salles(idSalle INTEGER PRIMARY KEY AUTOINCREMENT, ' +
+        'numeroSalle TEXT NOT NULL, UNIQUE(numeroSalle));'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS ' +
+        'classes(idClasse INTEGER PRIMARY KEY AUTOINCREMENT, ' +
+        'nomClasse TEXT NOT NULL, UNIQUE(nomClasse));'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS sessions(' +
+        'id INTEGER PRIMARY KEY AUTOINCREMENT,' +
+        'debut DATETIME NOT NULL,' +
+        'fin DATETIME NOT NULL,' +
+        'typeCours TEXT NOT NULL,' +
+        'uid TEXT,' +
+        'empreinte TEXT,' +
+        'heureDebut TEXT NOT NULL DEFAULT "",' +
+        'heureFin TEXT NOT NULL DEFAULT ""' +
+        ');'
+    )
+    # Link profs-session
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS lienPSe(' +
+        'idLienPSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
+        'idProf INTEGER NOT NULL,' +
+        'idSession INTEGER NOT NULL,' +
+
+        'FOREIGN KEY(idProf) REFERENCES profs(idProf),' +
+        'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
+        ');'
+    )
+    # Link salles-sessions
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS lienSaSe(' +
+        'idLienSaSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
+        'idSalle INTEGER NOT NULL,' +
+        'idSession INTEGER NOT NULL,' +
+
+        'FOREIGN KEY(idSalle) REFERENCES salles(idSalle),' +
+        'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
+        ');'
+    )
+    # Link cours-sessions
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS lienCoSe(' +
+        'idLienCoSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
+        'idCours INTEGER NOT NULL,' +
+        'idSession INTEGER NOT NULL,' +
+
+        'FOREIGN KEY(idCours) REFERENCES cours(idCours),' +
+        'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
+        ');'
+    )
+    # Link classes-sessions
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS lienClSe(' +
+        'idLienClSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
+        'idClasse INTEGER NOT NULL,' +
+        'idSession INTEGER NOT NULL,' +
+
+        'FOREIGN KEY(idClasse) REFERENCES classes(idClasse),' +
+        'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
+        ');'
+    )
+
+
+def add_session_columns(connection: sqlite3.Connection):
+    """
+        Schema version 2 : adds the session columns missing from databases created
+        before sessions were keyed on the event UIDs and stored their displayed hours
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    # Databases created before sessions were keyed on the event UIDs
+    columns = [column[1] for column in connection.execute('PRAGMA table_info(sessions);')]
+    for column in ('uid', 'empreinte'):
+        if column not in columns:
+            connection.execute('ALTER TABLE sessions ADD COLUMN ' + column + ' TEXT;')
+    # Databases created before the display hours were stored
+    if 'heureDebut' not in columns:
+        for column, source in (('heureDebut', 'debut'), ('heureFin', 'fin')):
+            connection.execute('ALTER TABLE sessions ADD COLUMN ' + column +
+                               ' TEXT NOT NULL DEFAULT "";')
+            connection.execute('UPDATE sessions SET ' + column + ' = ' +
+                               'substr(' + source + ', 12, 2) || "h" || ' +
+                               'substr(' + source + ', 15, 2) ' +
+                               'WHERE length(' + source + ') >= 16;')
+
+
+def create_indexes(connection: sqlite3.Connection):
+    """
+        Schema version 3 : indexes the lookup of the sessions of a class over a period.
+        Within a session, link indexes keep the insertion order of the rooms and teachers.
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute('CREATE INDEX IF NOT EXISTS idxSessionsDebut ON sessions(debut);')
+    connection.execute('CREATE INDEX IF NOT EXISTS idxLienClSeClasse ' +
+                       'ON lienClSe(idClasse, idSession);')
+    connection.execute('CREATE INDEX IF NOT EXISTS idxLienSaSeSession ' +
+                       'ON lienSaSe(idSession, idLienSaSe, idSalle);')
+    connection.execute('CREATE INDEX IF NOT EXISTS idxLienPSeSession ' +
+                       'ON lienPSe(idSession, idLienPSe, idProf);')
+    connection.execute('CREATE INDEX IF NOT EXISTS idxLienCoSeSession ' +
+                       'ON lienCoSe(idSession, idCours);')
+
+
+def create_snapshots(connection: sqlite3.Connection):
+    """
+        Schema version 4 : creates the table of the precomputed responses
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS snapshots(' +
+        'nomClasse TEXT NOT NULL,' +
+        'periode TEXT NOT NULL,' +
+        'corps BLOB NOT NULL,' +
+        'PRIMARY KEY(nomClasse, periode)' +
+        ') WITHOUT ROWID;'
+    )
+
+
+def create_meta(connection: sqlite3.Connection):
+    """
+        Schema version 5 : creates the table of the database state shared between the
+        refresher and the web server processes
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS meta(' +
+        'cle TEXT PRIMARY KEY,' +
+        'valeur' +
+        ') WITHOUT ROWID;'
+    )
+    connection.execute('INSERT OR IGNORE INTO meta(cle, valeur) VALUES ("generation", 0);')
+    connection.execute('INSERT OR IGNORE INTO meta(cle, valeur) VALUES ("miseAJour", NULL);')
+
+
+def merge_sessions(connection: sqlite3.Connection):
+    """
+        Schema version 6 : merges the copies of the sessions shared by several classes,
+        stored once per class before, into a single session linked to all of them
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute(
+        'UPDATE lienClSe SET idSession = (' +
+        'SELECT MIN(copie.id) FROM sessions ' +
+        'INNER JOIN sessions AS copie ' +
+        'ON copie.uid = sessions.uid AND copie.empreinte = sessions.empreinte ' +
+        'WHERE sessions.id = lienClSe.idSession) ' +
+        'WHERE idSession IN (SELECT id FROM sessions ' +
+        'WHERE uid IS NOT NULL AND empreinte IS NOT NULL);'
+    )
+    orphans = [(session_id,) for (session_id,) in connection.execute(
+        'SELECT id FROM sessions WHERE id NOT IN (SELECT idSession FROM lienClSe);')]
+    for table in ("lienSaSe", "lienPSe", "lienCoSe"):
+        connection.executemany('DELETE FROM ' + table + ' WHERE idSession = ?;', orphans)
+    connection.executemany('DELETE FROM sessions WHERE id = ?;', orphans)
+
+
+def create_intervals(connection: sqlite3.Connection):
+    """
+        Schema version 7 : creates the R*Tree index of the times of the sessions, in
+        minutes since the epoch, to find the sessions overlapping a time range
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS intervalles ' +
+                       'USING rtree_i32(id, debut, fin);')
+    connection.execute('INSERT INTO intervalles(id, debut, fin) ' +
+                       'SELECT id, CAST(strftime("%s", debut) AS INTEGER) / 60, ' +
+                       'CAST(strftime("%s", fin) AS INTEGER) / 60 FROM sessions ' +
+                       'WHERE heureDebut != "";')
+    connection.execute('CREATE INDEX IF NOT EXISTS idxLienPSeProf ' +
+                       'ON lienPSe(idProf, idSession);')
+
+
+def create_changes(connection: sqlite3.Connection):
+    """
+        Schema version 8 : creates the table of the sessions added (ajout), modified
+        (modification) or removed (suppression) in each class by each generation
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS changements(' +
+        'nomClasse TEXT NOT NULL,' +
+        'generation INTEGER NOT NULL,' +
+        'uid TEXT NOT NULL,' +
+        'nature TEXT NOT NULL,' +
+        'PRIMARY KEY(nomClasse, generation, uid)' +
+        ') WITHOUT ROWID;'
+    )
+
+
+def mark_snapshots(connection: sqlite3.Connection):
+    """
+        Schema version 9 : records whether the snapshots of each class are up to date,
+        a class without sessions having no snapshot
+    :param connection: The SQL connection
+    :return:
+        None
+    """
+    connection.execute('ALTER TABLE classes ADD COLUMN instantane INTEGER NOT NULL DEFAULT 0;')
+    connection.execute('UPDATE classes SET instantane = 1 WHERE nomClasse IN ' +
+                       '(SELECT nomClasse FROM snapshots);')
+
+
+MIGRATIONS = [create_tables, add_session_columns, create_indexes, create_snapshots,
+              create_meta, merge_sessions, create_intervals, create_changes, mark_snapshots]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# The sessions of a class over a period, teachers are aggregated by a subquery and
+# all-day sessions are not displayed
+SESSIONS_SELECT = (
+    'SELECT sessions.debut,' +
+    'sessions.fin,' +
+    'cours.idMatiere,' +
+    'cours.nomMatiere,' +
+    '(SELECT GROUP_CONCAT(profs.nomProf, ", ") FROM lienPSe ' +
+    'INNER JOIN profs ON profs.idProf = lienPSe.idProf ' +
+    'WHERE lienPSe.idSession = sessions.id),' +
+    'salles.numeroSalle,' +
+    'sessions.typeCours,' +
+    'sessions.uid,' +
+    'sessions.heureDebut,' +
+    'sessions.heureFin,' +
+    'classes.nomClasse ' +
+    'FROM sessions ' +
+
+    'INNER JOIN lienClSe ON lienClSe.idSession = sessions.id ' +
+    'INNER JOIN classes ON classes.idClasse = lienClSe.idClasse ' +
+
+    'INNER JOIN lienSaSe ON lienSaSe.idSession = sessions.id ' +
+    'INNER JOIN salles ON salles.idSalle = lienSaSe.idSalle ' +
+
+    'INNER JOIN lienCoSe ON lienCoSe.idSession = sessions.id ' +
+    'INNER JOIN cours ON cours.idCours = lienCoSe.idCours '
+)
+SESSIONS_QUERY = (
+    SESSIONS_SELECT +
+    'WHERE classes.nomClasse = ? AND sessions.debut BETWEEN ? AND ? ' +
+    'AND sessions.heureDebut != "" ' +
+    'ORDER BY sessions.debut, lienClSe.idLienClSe, lienSaSe.idLienSaSe;'
+)
+
+
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+# The rooms used during a time range, in minutes since the epoch
+BUSY_ROOMS_QUERY = (
+    'SELECT DISTINCT lienSaSe.idSalle FROM intervalles ' +
+    'INNER JOIN lienSaSe ON lienSaSe.idSession = intervalles.id ' +
+    'WHERE intervalles.debut < ? AND intervalles.fin > ?'
+)
+FREE_ROOMS_QUERY = (
+    'SELECT numeroSalle FROM salles WHERE numeroSalle != ? ' +
+    'AND idSalle NOT IN (' + BUSY_ROOMS_QUERY + ') ' +
+    'ORDER BY numeroSalle;'
+)
+# The times a teacher has sessions during a time range, in minutes since the epoch
+BUSY_TEACHER_QUERY = (
+    'SELECT DISTINCT sessions.debut, sessions.fin FROM profs ' +
+    'INNER JOIN lienPSe ON lienPSe.idProf = profs.idProf ' +
+    'INNER JOIN intervalles ON intervalles.id = lienPSe.idSession ' +
+    'INNER JOIN sessions ON sessions.id = intervalles.id ' +
+    'WHERE profs.nomProf = ? AND intervalles.debut < ? AND intervalles.fin > ? ' +
+    'ORDER BY sessions.debut, sessions.fin;'
+)
+
+
+def lap(stage: str, start: float):
+    """
+        Records the duration of a refresh stage
+    :param stage: The name of the stage
+    :param start: The perf_counter() value at the start of the stage
+    :return:
+        The perf_counter() value at the end of the stage
+    """
+    end = time.perf_counter()
+    METRICS.observe("hyperapi_refresh_stage_seconds", end - start, stage=stage)
+    return end
+
+
+def to_minutes(moment: str):
+    """
+        Converts a stored session time to its coordinate in the intervalles index
+    :param moment: The time, as YYYY-MM-DD HH:MM:SS
+    :return:
+        int, the minutes since the epoch
+    """
+    return ((datetime.date.fromisoformat(moment[:10]).toordinal() - EPOCH) * 1440 +
+            int(moment[11:13]) * 60 + int(moment[14:16]))
+
+# The sessions of every class, in the order of SESSIONS_QUERY within each class
+TIMETABLE_QUERY = (
+    SESSIONS_SELECT +
+    'WHERE sessions.heureDebut != "" ' +
+    'ORDER BY classes.nomClasse, sessions.debut, lienClSe.idLienClSe, lienSaSe.idLienSaSe;'
+)
+
+def changed_query(count: int):
+    """
+        Builds the query of the sessions of a class with some UIDs
+    :param count: The number of UIDs
+    :return:
+        str, expecting the class name then the UIDs
+    """
+    return (
+        SESSIONS_SELECT +
+        'WHERE classes.nomClasse = ? AND sessions.uid IN (' + ', '.join('?' * count) + ') ' +
+        'AND sessions.heureDebut != "" ' +
+        'ORDER BY sessions.debut, lienClSe.idLienClSe, lienSaSe.idLienSaSe;'
+    )
+
+
+def bulk_query(count: int):
+    """
+        Builds the query of the sessions of several classes starting in a date range
+    :param count: The number of classes
+    :return:
+        str, expecting the class names then the first and the excluded last dates
+    """
+    return (
+        SESSIONS_SELECT +
+        'WHERE classes.nomClasse IN (' + ', '.join('?' * count) + ') ' +
+        'AND sessions.debut >= ? AND sessions.debut < ? AND sessions.heureDebut != "" ' +
+        'ORDER BY sessions.debut, classes.nomClasse, lienClSe.idLienClSe, ' +
+        'lienSaSe.idLienSaSe;'
+    )
+
+
+def get_bounds(**kwargs):
+    """
+        Computes the dates between which sessions start for a period
+    :param kwargs: Either week, an ISO week like 2020-W03, or day, a date
+    :return:
+        A (begin, end) tuple of str
+    """
+    if "week" in kwargs:
+        iso_date = kwargs.get("week")
+        week = isoweek.Week(
+            int(iso_date.split("-W")[0]), int(iso_date.split("-W")[1])
+        )
+        begin = week.monday().strftime("%Y-%m-%d")
+        end = week.sunday().strftime("%Y-%m-%d")
+    else:
+        day = kwargs.get("day")
+        begin = str(day.strftime("%Y-%m-%d"))
+        end = str((day + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
+    return begin, end
+
+
+def get_period(**kwargs):
+    """
+        Names a period the way its snapshot is stored
+    :param kwargs: Either week, an ISO week like 2020-W03, or day, a date
+    :return:
+        str, like 2020-W03 or 2020-01-14
+    """
+    if "week" in kwargs:
+        iso_date = kwargs.get("week")
+        week = isoweek.Week(
+            int(iso_date.split("-W")[0]), int(iso_date.split("-W")[1])
+        )
+        return "{}-W{:02d}".format(week.year, week.week)
+    return kwargs.get("day").strftime("%Y-%m-%d")
+
+
+def to_lesson(row: tuple):
+    """
+        Builds a Lesson from a row of SESSIONS_QUERY
+    :param row: The desired row
+    :return:
+        A Lesson object
+    """
+    return hyperapi.Lesson(
+        idMatiere=row[2],
+        nomMatiere=row[3],
+        nomProf=row[4],
+        typeCours=row[6],
+        numeroSalle=row[5],
+        dateDebut=row[0][:10],
+        dateFin=row[1][:10],
+        heureDebut=row[8],
+        heureFin=row[9],
+        uid=row[7],
+    )
+
+
+# A lesson as encoded by json.dumps(sort_keys=True, separators=(",", ":"))
+LESSON_JSON = ('{{"dateDebut":{},"dateFin":{},"end_db":"","heureDebut":{},"heureFin":{},' +
+               '"idMatiere":{},"listeDevoirs":"","nomMatiere":{},"nomProf":{},' +
+               '"numeroSalle":{},"start_db":"","typeCours":{},"uid":{}}}')
+
+
+def encode_lesson(row: tuple):
+    """
+        Encodes a row of SESSIONS_QUERY as a JSON lesson, without building the Lesson object
+    :param row: The desired row
+    :return:
+        str
+    """
+    quote = json.encoder.encode_basestring_ascii
+    defaults = hyperapi.Lesson.DEFAULTS
+    return LESSON_JSON.format(
+        quote(row[0][:10] or defaults['dateDebut']),
+        quote(row[1][:10] or defaults['dateFin']),
+        quote(row[8] or defaults['heureDebut']),
+        quote(row[9] or defaults['heureFin']),
+        quote(row[2] or defaults['idMatiere']),
+        quote(row[3] or defaults['nomMatiere']),
+        quote(row[4] or defaults['nomProf']),
+        quote(row[5] or defaults['numeroSalle']),
+        quote(row[6] or defaults['typeCours']),
+        quote(row[7] or "")
+    )
+
+
+def encode(rows: list):
+    """
+        Encodes rows of SESSIONS_QUERY as the body of an API response
+    :param rows: The desired rows
+    :return:
+        bytes
+    """
+    return ("[" + ",".join(encode_lesson(row) for row in rows) + "]\n").encode()
+
+
+def explain(connection: sqlite3.Connection, query: str, parameters: tuple = ()):
+    """
+        Lists the full table scans and automatic indexes of the plan of a query
+    :param connection: The SQL connection
+    :param query: The SQL query
+    :param parameters: The parameters of the query
+    :return:
+        A list of the offending steps of the plan, empty if the query is fully indexed
+    """
+    return [step[3] for step in connection.execute('EXPLAIN QUERY PLAN ' + query, parameters)
+            if step[3].startswith('SCAN') or 'AUTOMATIC' in step[3]]
+
+
+class Batch:
+    """
+        Collects the writes of a build to send them as a few bulk statements.
+        Rooms, teachers, courses and classes ids are resolved in memory and the
+        ids of new sessions are allocated up front. A session shared by several
+        classes is stored once, linked to each of them.
+    """
+    DIMENSIONS = {
+        "salles": ('SELECT numeroSalle, idSalle FROM salles;',
+                   'INSERT INTO salles(numeroSalle) VALUES (?);'),
+        "profs": ('SELECT nomProf, idProf FROM profs;',
+                  'INSERT INTO profs(nomProf) VALUES (?);'),
+        "cours": ('SELECT idMatiere, nomMatiere, idCours FROM cours;',
+                  'INSERT INTO cours(idMatiere, nomMatiere) VALUES (?, ?);'),
+        "classes": ('SELECT nomClasse, idClasse FROM classes;',
+                    'INSERT INTO classes(nomClasse) VALUES (?);'),
+    }
+    LINKS = {
+        "lienSaSe": 'INSERT INTO lienSaSe(idSalle, idSession) VALUES (?, ?);',
+        "lienPSe": 'INSERT INTO lienPSe(idProf, idSession) VALUES (?, ?);',
+        "lienCoSe": 'INSERT INTO lienCoSe(idCours, idSession) VALUES (?, ?);',
+        "lienClSe": 'INSERT INTO lienClSe(idClasse, idSession) VALUES (?, ?);',
+    }
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        """
+            Loads the ids already present in the database
+        :param cursor: The SQL cursor
+        """
+        self.cursor = cursor
+        self.ids = {}
+        for table, (select, _) in self.DIMENSIONS.items():
+            self.ids[table] = {tuple(row[:-1]): row[-1] for row in cursor.execute(select)}
+        # Session ids are never reused, even after a deletion
+        self.next_session = max(
+            cursor.execute('SELECT MAX(id) FROM sessions;').fetchone()[0] or 0,
+            (cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = "sessions";')
+             .fetchone() or (0,))[0]
+        ) + 1
+        # The sessions by UID and fingerprint, with their number of classes
+        self.shared = {}
+        self.keys = {}
+        self.classes = {}
+        for session_id, uid, fingerprint, classes in cursor.execute(
+                'SELECT sessions.id, sessions.uid, sessions.empreinte, ' +
+                'COUNT(lienClSe.idSession) FROM sessions ' +
+                'LEFT JOIN lienClSe ON lienClSe.idSession = sessions.id ' +
+                'GROUP BY sessions.id;'):
+            self.shared[uid, fingerprint] = session_id
+            self.keys[session_id] = (uid, fingerprint)
+            self.classes[session_id] = classes
+        self.sessions = []
+        self.updates = []
+        self.intervals = []
+        self.unlinked = []
+        self.detached = []
+        self.removed = []
+        self.links = {table: [] for table in self.LINKS}
+        self.generation = cursor.execute(
+            'SELECT valeur + 1 FROM meta WHERE cle = "generation";').fetchone()[0]
+        self.changes = []
+        # The school classes whose timetable changed
+        self.changed = set()
+
+    def dimension_id(self, table: str, *key):
+        """
+            Retrieves the id of a room, teacher, course or class, adding it if needed
+        :param table: The table of the value
+        :param key: The unique columns of the value
+        :return:
+            int
+        """
+        ids = self.ids[table]
+        if key not in ids:
+            self.cursor.execute(self.DIMENSIONS[table][1], key)
+            ids[key] = self.cursor.lastrowid
+        return ids[key]
+
+    def change(self, school_class: str, uid: str, nature: str):
+        """
+            Records a change of the timetable of a school class for the change feed
+        :param school_class: The school class
+        :param uid: The key of the session in the calendar of the class
+        :param nature: ajout, modification or suppression
+        :return:
+            None
+        """
+        self.changed.add(school_class)
+        # Sessions stored without UID cannot be told apart by the clients
+        if uid is not None:
+            self.changes.append((school_class, self.generation, uid, nature))
+
+    def find_session(self, uid: str, fingerprint: str):
+        """
+            Looks for a session already stored for another class
+        :param uid: The key of the session in the calendar of its class
+        :param fingerprint: The digest of the session content
+        :return:
+            The id of the session, None if there is none
+        """
+        return self.shared.get((uid, fingerprint))
+
+    def add_session(self, session: hyperapi.Lesson, uid: str, fingerprint: str,
+                    school_class: str):
+        """
+            Adds a session and its links
+        :param session: The desired session
+        :param uid: The key of the session in the calendar of its class
+        :param fingerprint: The digest of the session content
+        :param school_class: The school class of the session
+        :return:
+            None
+        """
+        session_id = self.next_session
+        self.next_session += 1
+        self.sessions.append((session_id,
+                              session.dateDebut + " " + session.start_db,
+                              session.dateFin + " " + session.end_db,
+                              session.typeCours, uid, fingerprint) + self.hours(session))
+        self.interval(session, session_id)
+        self.shared[uid, fingerprint] = session_id
+        self.keys[session_id] = (uid, fingerprint)
+        self.classes[session_id] = 0
+        self.attach(session_id, school_class)
+        self.link(session, session_id)
+
+    def attach(self, session_id: int, school_class: str):
+        """
+            Links a session to a school class
+        :param session_id: The id of the session
+        :param school_class: The school class
+        :return:
+            None
+        """
+        self.links["lienClSe"].append((self.dimension_id("classes", school_class), session_id))
+        self.classes[session_id] += 1
+
+    def detach(self, session_id: int, school_class: str):
+        """
+            Unlinks a session from a school class, removing it if no class has it anymore
+        :param session_id: The id of the session
+        :param school_class: The school class
+        :return:
+            None
+        """
+        self.detached.append((self.dimension_id("classes", school_class), session_id))
+        self.changed.add(school_class)
+        self.classes[session_id] -= 1
+        if not self.classes[session_id]:
+            self.removed.append((session_id,))
+            key = self.keys.pop(session_id)
+            if self.shared.get(key) == session_id:
+                del self.shared[key]
+
+    def update_session(self, session: hyperapi.Lesson, session_id: int, fingerprint: str):
+        """
+            Replaces the content of a session, keeping its id and school class
+        :param session: The new content of the session
+        :param session_id: The id of the session
+        :param fingerprint: The digest of the session content
+        :return:
+            None
+        """
+        self.updates.append((session.dateDebut + " " + session.start_db,
+                             session.dateFin + " " + session.end_db,
+                             session.typeCours, fingerprint) + self.hours(session) +
+                            (session_id,))
+        self.interval(session, session_id)
+        key = self.keys[session_id]
+        if self.shared.get(key) == session_id:
+            del self.shared[key]
+        self.keys[session_id] = (key[0], fingerprint)
+        self.shared[key[0], fingerprint] = session_id
+        self.unlinked.append((session_id,))
+        self.link(session, session_id)
+
+    @staticmethod
+    def hours(session: hyperapi.Lesson):
+        """
+            Computes the displayed hours of a session, empty for all-day sessions
+        :param session: The desired session
+        :return:
+            A (heureDebut, heureFin) tuple
+        """
+        if not session.start_db:
+            return "", ""
+        return session.heureDebut, session.heureFin
+
+    def interval(self, session: hyperapi.Lesson, session_id: int):
+        """
+            Indexes the times of a session, all-day sessions are not indexed
+        :param session: The desired session
+        :param session_id: The id of the session
+        :return:
+            None
+        """
+        if session.start_db:
+            self.intervals.append((session_id,
+                                   to_minutes(session.dateDebut + " " + session.start_db),
+                                   to_minutes(session.dateFin + " " + session.end_db)))
+
+    def link(self, session: hyperapi.Lesson, session_id: int):
+        """
+            Links a session to its rooms, teachers and course
+        :param session: The desired session
+        :param session_id: The id of the session
+        :return:
+            None
+        """
+        for room in session.numeroSalle.split(","):
+            self.links["lienSaSe"].append((self.dimension_id("salles", room), session_id))
+        for teacher in session.nomProf.split(", "):
+            self.links["lienPSe"].append((self.dimension_id("profs", teacher), session_id))
+        self.links["lienCoSe"].append(
+            (self.dimension_id("cours", session.idMatiere, session.nomMatiere), session_id))
+
+    def write(self):
+        """
+            Sends the collected writes to the database
+        :return:
+            None
+        """
+        self.cursor.executemany('DELETE FROM lienClSe WHERE idClasse = ? AND idSession = ?;',
+                                self.detached)
+        for table in ("lienSaSe", "lienPSe", "lienCoSe"):
+            self.cursor.executemany('DELETE FROM ' + table + ' WHERE idSession = ?;',
+                                    self.unlinked + self.removed)
+        self.cursor.executemany('DELETE FROM sessions WHERE id = ?;', self.removed)
+        self.cursor.executemany('DELETE FROM intervalles WHERE id = ?;',
+                                self.unlinked + self.removed)
+        self.cursor.executemany('INSERT INTO intervalles(id, debut, fin) VALUES (?, ?, ?);',
+                                self.intervals)
+        self.cursor.executemany(
+            'UPDATE sessions SET debut = ?, fin = ?, typeCours = ?, empreinte = ?, ' +
+            'heureDebut = ?, heureFin = ? WHERE id = ?;', self.updates)
+        self.cursor.executemany(
+            'INSERT INTO sessions(id, debut, fin, typeCours, uid, empreinte, ' +
+            'heureDebut, heureFin) VALUES (?, ?, ?, ?, ?, ?, ?, ?);', self.sessions)
+        for table, insert in self.LINKS.items():
+            self.cursor.executemany(insert, self.links[table])
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO changements(nomClasse, generation, uid, nature) ' +
+            'VALUES (?, ?, ?, ?);', self.changes)
+
+
+def from_config(parser: ConfigParser, readonly: bool = False, serving: bool = True):
+    """
+        Creates the DatabaseManager described by the database config file
+    :param parser: The parsed config/database.config
+    :param readonly: Whether the manager only serves the database
+    :param serving: Whether the manager answers requests, the timetable is only
+        loaded in memory then
+    :return:
+        A DatabaseManager
+    """
+    return DatabaseManager(
+        parser.get('planning', 'path'),
+        base_url=parser.get('hyperplanning', 'url', fallback=HYPERPLANNING_URL),
+        workers=parser.getint('hyperplanning', 'workers', fallback=hyperapi.DEFAULT_WORKERS),
+        timeout=parser.getfloat('hyperplanning', 'timeout', fallback=hyperapi.DEFAULT_TIMEOUT),
+        retries=parser.getint('hyperplanning', 'retries', fallback=hyperapi.DEFAULT_RETRIES),
+        shadow=parser.getboolean('planning', 'shadow', fallback=False),
+        snapshots=parser.getboolean('planning', 'snapshots', fallback=False),
+        processes=parser.getint('planning', 'processes', fallback=1),
+        store=parser.get('planning', 'store', fallback=None) or None,
+        wal=parser.getboolean('planning', 'wal', fallback=False),
+        busy_timeout=parser.getfloat('planning', 'busy_timeout', fallback=5.0),
+        connections=parser.getint('planning', 'connections', fallback=8),
+        memory=serving and parser.getboolean('planning', 'memory', fallback=False),
+        history=parser.getint('planning', 'history', fallback=100),
+        readonly=readonly)
+
+
 class DatabaseManager:
     """
         Class to handle the .ical to database conversion
     """
-    def __init__(self, database):
+    def __init__(self, database, base_url: str = HYPERPLANNING_URL,
+                 workers: int = hyperapi.DEFAULT_WORKERS,
+                 timeout: float = hyperapi.DEFAULT_TIMEOUT,
+                 retries: int = hyperapi.DEFAULT_RETRIES,
+                 shadow: bool = False, snapshots: bool = False, processes: int = 1,
+                 store: str = None, wal: bool = False, busy_timeout: float = 5.0,
+                 connections: int = 8, memory: bool = False, history: int = 100,
+                 readonly: bool = False):
         """
             Saves the school classes and builds the database
         :param database: The desired database
+        :param base_url: The HyperPlanning server serving the .ical files
+        :param workers: The maximum number of simultaneous downloads
+        :param timeout: The timeout of each download attempt, in seconds
+        :param retries: The number of download attempts after the first one
+        :param shadow: Whether to build into a staging copy of the database
+            which replaces it once complete
+        :param snapshots: Whether to precompute the responses of every week and day
+            at build time
+        :param processes: The number of processes parsing the calendars, 1 to parse
+            them in the building thread
+        :param store: The directory keeping the downloaded calendars and their lessons,
+            None to keep nothing
+        :param wal: Whether the database is journaled with a write-ahead log, which
+            lets requests read the previous state of the database while a build writes
+            it in place, staging copies are then not needed
+        :param busy_timeout: The time a connection waits for a lock, in seconds
+        :param connections: The number of idle read connections kept open
+        :param memory: Whether responses are served from the whole timetable, loaded
+            in memory once per generation, instead of querying the database
+        :param history: The number of generations whose changes are kept for the
+            change feed
+        :param readonly: Whether the manager only serves the database built by another
+            process, in which case the schema is not migrated either
         """
         self.database = database
-        self.classes = parse_config()
-        self.last_session = None
-
-        # DB tables creation
-        connection = sqlite3.connect(self.database)
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS ' +
-            'cours(idCours INTEGER PRIMARY KEY AUTOINCREMENT, ' +
-            'idMatiere TEXT NOT NULL, nomMatiere TEXT NOT NULL, ' +
-            'UNIQUE(idMatiere, nomMatiere));'
-        )
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS ' +
-            'profs(idProf INTEGER PRIMARY KEY AUTOINCREMENT, ' +
-            'nomProf TEXT NOT NULL, UNIQUE(nomProf));'
-        )
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS ' +
-            'salles(idSalle INTEGER PRIMARY KEY AUTOINCREMENT, ' +
-            'numeroSalle TEXT NOT NULL, UNIQUE(numeroSalle));'
-        )
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS ' +
-            'classes(idClasse INTEGER PRIMARY KEY AUTOINCREMENT, ' +
-            'nomClasse TEXT NOT NULL, UNIQUE(nomClasse));'
-        )
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS sessions(' +
-            'id INTEGER PRIMARY KEY AUTOINCREMENT,' +
-            'debut DATETIME NOT NULL,' +
-            'fin DATETIME NOT NULL,' +
-            'typeCours TEXT NOT NULL' +
-            ');'
-        )
-        # Link profs-session
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS lienPSe(' +
-            'idLienPSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
-            'idProf INTEGER NOT NULL,' +
-            'idSession INTEGER NOT NULL,' +
-
-            'FOREIGN KEY(idProf) REFERENCES profs(idProf),' +
-            'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
-            ');'
-        )
-        # Link salles-sessions
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS lienSaSe(' +
-            'idLienSaSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
-            'idSalle INTEGER NOT NULL,' +
-            'idSession INTEGER NOT NULL,' +
-
-            'FOREIGN KEY(idSalle) REFERENCES salles(idSalle),' +
-            'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
-            ');'
-        )
-        # Link cours-sessions
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS lienCoSe(' +
-            'idLienCoSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
-            'idCours INTEGER NOT NULL,' +
-            'idSession INTEGER NOT NULL,' +
-
-            'FOREIGN KEY(idCours) REFERENCES cours(idCours),' +
-            'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
-            ');'
-        )
-        # Link classes-sessions
-        connection.execute(
-            'CREATE TABLE IF NOT EXISTS lienClSe(' +
-            'idLienClSe INTEGER PRIMARY KEY AUTOINCREMENT,' +
-            'idClasse INTEGER NOT NULL,' +
-            'idSession INTEGER NOT NULL,' +
-
-            'FOREIGN KEY(idClasse) REFERENCES classes(idClasse),' +
-            'FOREIGN KEY(idSession) REFERENCES sessions(idSession)' +
-            ');'
-        )
-        connection.close()
+        self.classes = parse_config(base_url)
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.session = hyperapi.create_session(workers)
+        self.wal = wal
+        # With a write-ahead log, replacing the database file would mix up the log
+        # of the old file with the new one
+        self.shadow = shadow and not wal
+        if shadow and wal:
+            LOGGER.warning("Staging copies are disabled with a write-ahead log")
+        self.busy_timeout = busy_timeout
+        self.snapshots = snapshots
+        self.processes = processes
+        self.store = hyperapi.CalendarStore(store) if store and not readonly else None
+        self.readonly = readonly
+        # The database file state the generation was last read at
+        self.signature = None
+        self.generation = None
+        # Held by the build in progress
+        self.lock = threading.Lock()
+
+        if not readonly:
+            connection = sqlite3.connect(self.database, timeout=busy_timeout)
+            connection.execute('PRAGMA journal_mode = {};'.format("WAL" if wal else "DELETE"))
+            migrate(connection)
+            connection.close()
+        self.pool = pool.ConnectionPool(self.connect, self.database, connections)
+        self.timetable = timetable.Timetable() if memory else None
+        self.history = history
+
+    def connect(self):
+        """
+            Opens a connection to read the database, usable from any thread
+        :return:
+            A sqlite3.Connection, read-only in readonly mode
+        """
+        if self.readonly:
+            connection = sqlite3.connect("file:{}?mode=ro".format(
+                urllib.request.pathname2url(os.path.abspath(self.database))), uri=True,
+                timeout=self.busy_timeout, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self.database, timeout=self.busy_timeout,
+                                         check_same_thread=False)
+        connection.execute('PRAGMA query_only = ON;')
+        return connection
+
+    def get_generation(self):
+        """
+            Retrieves the generation of the database, incremented by each build which
+            changes it. It is only read again when the database file, or its write-ahead
+            log, changes.
+        :return:
+            int
+        """
+        signature = []
+        for path in (self.database, self.database + "-wal"):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        if signature != self.signature:
+            with self.pool.connection() as connection:
+                self.generation = connection.execute(
+                    'SELECT valeur FROM meta WHERE cle = "generation";').fetchone()[0]
+            self.signature = signature
+        return self.generation
+
+    def get_state(self):
+        """
+            Retrieves the state of the database shared by the refresher
+        :return:
+            A dict with the generation, the time of the last change (miseAJour)
+            and of the last successful refresh (verification), None if unknown
+        """
+        with self.pool.connection() as connection:
+            state = dict(connection.execute('SELECT cle, valeur FROM meta;'))
+        return {"generation": state.get("generation"),
+                "miseAJour": state.get("miseAJour"),
+                "verification": state.get("verification")}
+
+    def refresh_forever(self, interval: float = 3600.0, delay: float = 0.0,
+                        jitter: float = 0.0):
+        """
+            Refreshes the calendars periodically, each one at its own interval. The calendars
+            due at the same time are refreshed by a single build, a build never overlapping
+            the next one, and a calendar which fails is retried with an exponential backoff
+            without delaying the others.
+        :param interval: The time between two refreshes of the classes without an interval
+            of their own, in seconds
+        :param delay: The time before the first build, in seconds
+        :param jitter: The fraction of its interval by which the refresh of each calendar
+            is randomly delayed or advanced, to spread the downloads over time
+        :return:
+            Never returns
+        """
+        intervals = {}
+        for school_class in self.classes:
+            intervals[school_class.url] = min(intervals.get(school_class.url, float('inf')),
+                                              school_class.intervalle or interval)
+        # The last persisted database is served from memory while the first build runs
+        self.load()
+        start = time.monotonic() + delay
+        schedule = {url: start for url in intervals}
+        failures = {}
+        while True:
+            time.sleep(max(0.0, min(schedule.values()) - time.monotonic()))
+            now = time.monotonic()
+            due = {url for url, moment in schedule.items() if moment <= now}
+            try:
+                failed = self.build(due)
+            except Exception as exception:
+                LOGGER.exception("%s occured while building the database",
+                                 type(exception).__name__)
+                failed = due
+            now = time.monotonic()
+            for url in due:
+                if url in failed:
+                    failures[url] = failures.get(url, 0) + 1
+                    wait = min(intervals[url], BACKOFF_DELAY * 2 ** (failures[url] - 1))
+                else:
+                    failures.pop(url, None)
+                    wait = intervals[url]
+                schedule[url] = now + wait * (1 + random.uniform(-jitter, jitter))
+
+    def build(self, urls: set = None, offline: bool = False, moment: str = None):
+        """
+            Updates the database from the calendars which changed, one build at a time
+        :param urls: The URLs of the calendars to refresh, None for all of them
+        :param offline: Whether to read the calendars from the store instead of
+            downloading them
+        :param moment: When offline, the time to replay the calendars as of, as
+            YYYY-MM-DD HH:MM:SS, None for the last stored ones
+        :return:
+            The set of the URLs which could not be downloaded or stored
+        """
+        with self.lock, METRICS.timer("hyperapi_refresh_seconds"):
+            failed = self.update({school_class.url for school_class in self.classes}
+                                 if urls is None else urls, offline, moment)
+        # Loaded before the requests need it, as they are served from the database until then
+        self.load()
+        return failed
 
-    def build(self):
+    def load(self):
         """
-            Updates the database every hour
+            Loads the timetable of the current generation in memory if it is not loaded
+            yet, the requests being answered from the database meanwhile
         :return:
             None
         """
-        # Recursive function to update the DB each hour
-        threading.Timer(3600.00, self.build).start()
+        if self.timetable is None:
+            return
+        try:
+            self.timetable.refresh(self.get_generation(), self.load_timetable)
+        except sqlite3.Error as exception:
+            LOGGER.exception("%s occured while loading the timetable", type(exception).__name__)
 
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
+    def watch_forever(self, interval: float = WATCH_INTERVAL):
+        """
+            Loads the timetable of each new generation in memory, when the database is
+            built by another process
+        :param interval: The time between two checks for a new generation, in seconds
+        :return:
+            Never returns
+        """
+        while True:
+            self.load()
+            time.sleep(interval)
 
-        # Delete all content to escape conflicts
-        cursor.execute("DELETE FROM cours;")
-        cursor.execute("DELETE FROM profs;")
-        cursor.execute("DELETE FROM salles;")
-        cursor.execute("DELETE FROM classes;")
-        cursor.execute("DELETE FROM sessions;")
-        cursor.execute("DELETE FROM lienSaSe;")
-        cursor.execute("DELETE FROM lienPSe;")
-        cursor.execute("DELETE FROM lienClSe;")
-        cursor.execute("DELETE FROM lienCoSe;")
+    def update(self, urls: set, offline: bool = False, moment: str = None):
+        """
+            Updates the database from the calendars which changed
+        :param urls: The URLs of the calendars to refresh
+        :param offline: Whether to read the calendars from the store
+        :param moment: When offline, the time to replay the calendars as of
+        :return:
+            The set of the URLs which could not be downloaded or stored
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        mark = time.perf_counter()
+        calendars = {}
+        failed = set()
+        if offline:
+            if self.store is None:
+                raise ValueError("Offline builds need a calendar store")
+            for url in urls:
+                text = self.store.load(url, moment)
+                if text is None:
+                    LOGGER.error("No stored calendar for %s", url)
+                    failed.add(url)
+                else:
+                    calendars[url] = text
+                    # The next download has to be complete to replace the replayed calendar
+                    hyperapi.forget(url)
+        else:
+            # Download the calendars which changed since the last build
+            for url, text, exception in hyperapi.fetch_calendars(
+                    urls, self.workers,
+                    timeout=self.timeout, retries=self.retries, session=self.session,
+                    conditional=True):
+                if exception is not None:
+                    LOGGER.error("%s occured while downloading %s : %s",
+                                 type(exception).__name__, url, exception)
+                    failed.add(url)
+                elif text is not None:
+                    calendars[url] = text
+        for classe in self.classes:
+            if classe.url in failed:
+                METRICS.increment("hyperapi_download_failures_total", classe=classe.nom)
+        mark = lap("fetch", mark)
 
-        connection.commit()
+        # Readers keep using the current database until the staging one replaces it.
+        # With a write-ahead log, requests keep reading the previous state of the
+        # database until the build commits.
+        target = self.database + ".staging" if self.shadow else self.database
+        connection = None
+        try:
+            if self.store is not None and not offline:
+                for url, text in calendars.items():
+                    self.store.save(url, text, now)
 
-        for i in range(0, len(self.classes)):
-            sessions_list = hyperapi.scrape(self.classes[i].url)
-            school_class = self.classes[i].nom
-
-            for session in sessions_list:
-                if not session.is_empty():
-                    try:
-                        self.add_session(session, cursor)
-                    except (sqlite3.IntegrityError, TypeError) as exception:
-                        LOGGER.exception("%s occured while adding a session",
-                                         type(exception).__name__)
-                    try:
-                        self.add_room(session.numeroSalle, cursor)
-                    except (sqlite3.IntegrityError, AttributeError) as exception:
-                        LOGGER.exception("%s occured while adding a session",
-                                         type(exception).__name__)
-                    try:
-                        self.add_teacher(session.nomProf, cursor)
-                    except (sqlite3.IntegrityError, AttributeError) as exception:
-                        LOGGER.exception("%s occured while adding a session",
-                                         type(exception).__name__)
-                    try:
-                        self.add_course(session.idMatiere, session.nomMatiere, cursor)
-                    except (sqlite3.IntegrityError, AttributeError) as exception:
-                        LOGGER.exception("%s occured while adding a session",
-                                         type(exception).__name__)
-                    try:
-                        self.add_class(school_class, cursor)
-                    except (sqlite3.IntegrityError, AttributeError) as exception:
-                        LOGGER.exception("%s occured while adding a session",
-                                         type(exception).__name__)
+            # Classes removed from the config
+            connection = sqlite3.connect(self.database, timeout=self.busy_timeout)
+            configured = {classe.nom for classe in self.classes}
+            removed = [school_class for (school_class,) in connection.execute(
+                "SELECT nomClasse FROM classes;") if school_class not in configured]
+            # Classes stored before snapshots were enabled
+            unmaterialized = [school_class for (school_class,) in connection.execute(
+                "SELECT nomClasse FROM classes WHERE instantane = 0;")
+                if school_class in configured] if self.snapshots else []
+
+            connection.close()
+            if not calendars and not removed and not unmaterialized:
+                self.verify(now, failed)
+                return failed
+
+            if self.shadow:
+                self.copy(target)
+                connection = sqlite3.connect(target)
+                # The staging database is discarded on failure, no need for a journal
+                connection.execute('PRAGMA journal_mode = OFF;')
+                connection.execute('PRAGMA synchronous = OFF;')
+            else:
+                connection = sqlite3.connect(target, timeout=self.busy_timeout)
+                if self.wal:
+                    connection.execute('PRAGMA synchronous = NORMAL;')
+            cursor = connection.cursor()
+            mark = lap("copy", mark)
+
+            for school_class in removed:
+                self.remove_class(school_class, cursor)
+
+            parsed = self.parse(calendars, failed)
+            mark = lap("parse", mark)
+            batch = self.synchronize(parsed, cursor, failed)
+            mark = lap("sync", mark)
+            if not batch.changed and not removed and not unmaterialized:
+                # The calendars were downloaded again without any change to their lessons
+                connection.rollback()
+                connection.close()
+                if self.shadow:
+                    os.remove(target)
+                self.verify(now, failed)
+                return failed
+            batch.write()
+            mark = lap("write", mark)
+
+            self.prune(cursor)
+            self.materialize(removed + unmaterialized +
+                             [classe.nom for classe in self.classes
+                              if classe.nom in batch.changed and classe.nom not in unmaterialized],
+                             cursor)
+            mark = lap("materialize", mark)
+            cursor.execute('UPDATE meta SET valeur = valeur + 1 WHERE cle = "generation";')
+            cursor.execute('DELETE FROM changements WHERE generation <= ' +
+                           '(SELECT valeur FROM meta WHERE cle = "generation") - ?;',
+                           (self.history,))
+            cursor.execute('UPDATE meta SET valeur = ? WHERE cle = "miseAJour";', (now,))
+            # The data is only known to be current when every calendar could be checked
+            if not failed:
+                cursor.execute('INSERT OR REPLACE INTO meta(cle, valeur) ' +
+                               'VALUES ("verification", ?);', (now,))
+            connection.commit()
+            connection.close()
+
+            if self.shadow:
+                with open(target, 'rb') as staging:
+                    os.fsync(staging.fileno())
+                os.replace(target, self.database)
+            committed = time.perf_counter()
+            lap("commit", mark)
+            # The classes of a build are committed together
+            for classe in self.classes:
+                if classe.url in parsed:
+                    METRICS.set("hyperapi_refresh_class_seconds", committed - mark,
+                                classe=classe.nom, stage="commit")
+        except Exception:
+            METRICS.increment("hyperapi_refreshes_total", result="failed")
+            if connection is not None:
+                connection.close()
+            if self.shadow and os.path.exists(target):
+                os.remove(target)
+            # The calendars have to be downloaded again for the next build to store them
+            for url in calendars:
+                hyperapi.forget(url)
+            raise
 
-        connection.commit()
-        connection.close()
         LOGGER.debug(
-            "[+] Database has been updated : {}"
-            .format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            "[+] Database has been updated ({} changed calendars) : {}"
+            .format(len(calendars), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         )
+        METRICS.increment("hyperapi_refreshes_total", result="updated")
+        return failed
 
-    def add_room(self, room_list: str, cursor: sqlite3.Cursor):
+    def verify(self, now: str, failed: set):
         """
-            Adds a numeroSalle list to the database
-        :param room_list: The desired numeroSalle list
-        :param cursor: The SQL cursor
+            Records that the database was found up to date with the calendars, unless
+            some of them could not be checked
+        :param now: The time of the refresh
+        :param failed: The URLs which could not be downloaded or stored
+        :return:
+            None
+        """
+        if failed:
+            LOGGER.debug("[-] {} calendars could not be checked : {}".format(len(failed), now))
+            METRICS.increment("hyperapi_refreshes_total", result="failed")
+            return
+        connection = sqlite3.connect(self.database, timeout=self.busy_timeout)
+        try:
+            connection.execute('INSERT OR REPLACE INTO meta(cle, valeur) ' +
+                               'VALUES ("verification", ?);', (now,))
+            connection.commit()
+        finally:
+            connection.close()
+        LOGGER.debug("[+] Database is up to date : {}".format(now))
+        METRICS.increment("hyperapi_refreshes_total", result="unchanged")
+
+    @staticmethod
+    def skip(url: str, exception: Exception, failed: set):
+        """
+            Leaves a calendar out of the current build, the others being stored
+        :param url: The URL of the calendar
+        :param exception: The error the calendar caused
+        :param failed: The URLs which could not be refreshed
         :return:
             None
         """
-        rooms = room_list.split(",")
-        for room in rooms:
-            cursor.execute(
-                'INSERT OR IGNORE INTO salles(numeroSalle) VALUES("' + room + '");'
-            )
-            id = cursor.execute('SELECT idSalle FROM salles WHERE numeroSalle="' + room + '"').fetchone()[0]
-            cursor.execute(
-                'INSERT OR IGNORE INTO lienSaSe(idSession, idSalle) VALUES(' +
-                self.last_session +
-                ', ' +
-                str(id) +
-                ');'
-            )
-
-    def add_teacher(self, teachers_list: str, cursor:sqlite3.Cursor):
-        """
-            Adds a list of teachers to the database
-        :param teachers_list: A list of teachers
+        LOGGER.error("%s occured while storing %s : %s", type(exception).__name__, url, exception)
+        failed.add(url)
+        # The calendar has to be downloaded again to be retried
+        hyperapi.forget(url)
+
+    def parse(self, calendars: dict, failed: set):
+        """
+            Parses the calendars, reusing the lessons of the contents already parsed by a
+            previous build. A calendar which cannot be parsed is left out.
+        :param calendars: The contents of the .ical files, by URL
+        :param failed: The URLs which could not be refreshed, completed with the ones
+            of the calendars which could not be parsed
+        :return:
+            The Lesson lists of the calendars, by URL
+        """
+        parsed = {}
+        if self.store is not None:
+            for url, text in calendars.items():
+                lessons = self.store.get_lessons(text)
+                if lessons is not None:
+                    parsed[url] = lessons
+        missing = [url for url in calendars if url not in parsed]
+        if self.processes > 1 and len(missing) > 1:
+            for url, (lessons, exception) in zip(missing, hyperapi.parse_calendars(
+                    [calendars[url] for url in missing], self.processes)):
+                if exception is None:
+                    parsed[url] = lessons
+                else:
+                    self.skip(url, exception, failed)
+        else:
+            for url in missing:
+                start = time.perf_counter()
+                try:
+                    parsed[url] = list(hyperapi.parse_lines(calendars[url].splitlines()))
+                except Exception as exception:
+                    self.skip(url, exception, failed)
+                    continue
+                # Calendars parsed by the process pool are only timed as a whole
+                for classe in self.classes:
+                    if classe.url == url:
+                        METRICS.set("hyperapi_refresh_class_seconds",
+                                    time.perf_counter() - start, classe=classe.nom, stage="parse")
+        if self.store is not None:
+            for url in missing:
+                if url in parsed:
+                    self.store.put_lessons(calendars[url], parsed[url])
+        return parsed
+
+    def synchronize(self, parsed: dict, cursor: sqlite3.Cursor, failed: set):
+        """
+            Synchronizes the school classes with their parsed calendars. When the sessions
+            of a calendar cannot be stored, its writes are undone and the other calendars
+            are synchronized again without it.
+        :param parsed: The Lesson lists of the calendars, by URL
         :param cursor: The SQL cursor
+        :param failed: The URLs which could not be refreshed, completed with the ones
+            of the calendars which could not be stored
+        :return:
+            The Batch of the writes of the build
+        """
+        cursor.execute('SAVEPOINT synchronisation;')
+        while True:
+            batch = Batch(cursor)
+            classe = None
+            try:
+                for classe in self.classes:
+                    if classe.url not in parsed:
+                        continue
+                    start = time.perf_counter()
+                    self.sync_class(classe.nom, parsed[classe.url], batch)
+                    METRICS.set("hyperapi_refresh_class_seconds", time.perf_counter() - start,
+                                classe=classe.nom, stage="insert")
+                return batch
+            except sqlite3.Error:
+                raise
+            except Exception as exception:
+                self.skip(classe.url, exception, failed)
+                del parsed[classe.url]
+                # Rooms, teachers, courses and classes are inserted as they are found
+                cursor.execute('ROLLBACK TO synchronisation;')
+
+    def copy(self, path: str):
+        """
+            Copies the database to a new file
+        :param path: The path of the copy, overwritten if it exists
+        :return:
+            None
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        source = sqlite3.connect(self.database)
+        copy = sqlite3.connect(path)
+        try:
+            source.backup(copy)
+        finally:
+            copy.close()
+            source.close()
+
+    @staticmethod
+    def sync_class(school_class: str, sessions_list: list, batch: Batch):
+        """
+            Synchronizes the sessions of a school class with its calendar.
+            Sessions are matched on their event UID : new ones are linked to the same
+            session of another class or inserted, modified ones are updated in place
+            unless another class shares them, and the ones which vanished are unlinked.
+            Sessions stored before they were keyed on their UID are replaced.
+        :param school_class: The desired school class
+        :param sessions_list: The Lesson list scraped from the calendar of the class
+        :param batch: The writes of the current build
         :return:
             None
         """
-        teachers = teachers_list.split(", ")
-        for teacher in teachers:
-            cursor.execute('INSERT OR IGNORE INTO profs(nomProf) VALUES("' + teacher + '");')
-            id = cursor.execute('SELECT idProf FROM profs WHERE nomProf="' + teacher + '"').fetchone()[0]
-            cursor.execute(
-                'INSERT OR IGNORE INTO lienPSe(idSession, idProf) VALUES(' +
-                self.last_session +
-                ', ' +
-                str(id) +
-                ');'
-            )
-
-    def add_course(self, course_id: str, course_name: str, cursor:sqlite3.Cursor):
-        """
-            Adds a course to the database
-        :param course_id: The course ID retrieved from Hyperplanning
-        :param course_name: The course nomMatiere
+        stored = {}
+        for session_id, uid, fingerprint in batch.cursor.execute(
+                'SELECT sessions.id, sessions.uid, sessions.empreinte FROM sessions ' +
+                'INNER JOIN lienClSe ON lienClSe.idSession = sessions.id ' +
+                'INNER JOIN classes ON classes.idClasse = lienClSe.idClasse ' +
+                'WHERE classes.nomClasse = ?;', (school_class,)).fetchall():
+            if uid is None:
+                # Stored by a version which did not key sessions on their UID
+                batch.detach(session_id, school_class)
+            else:
+                stored[uid] = (session_id, fingerprint)
+
+        seen = set()
+        for session in sessions_list:
+            if session.is_empty():
+                continue
+            fingerprint = session.fingerprint()
+            # Events without UID are matched on their content
+            uid = session.uid or fingerprint
+            while uid in seen:
+                uid += "+"
+            seen.add(uid)
+
+            if uid in stored and stored[uid][1] == fingerprint:
+                continue
+            batch.change(school_class, uid, "modification" if uid in stored else "ajout")
+            shared = batch.find_session(uid, fingerprint)
+            if uid in stored:
+                session_id = stored[uid][0]
+                if shared is None and batch.classes[session_id] == 1:
+                    batch.update_session(session, session_id, fingerprint)
+                    continue
+                batch.detach(session_id, school_class)
+            if shared is None:
+                batch.add_session(session, uid, fingerprint, school_class)
+            else:
+                batch.attach(shared, school_class)
+
+        for uid, (session_id, _) in stored.items():
+            if uid not in seen:
+                batch.detach(session_id, school_class)
+                batch.change(school_class, uid, "suppression")
+
+    @staticmethod
+    def remove_sessions(sessions_ids: list, cursor: sqlite3.Cursor):
+        """
+            Removes sessions and their links from the database
+        :param sessions_ids: The ids of the desired sessions
         :param cursor: The SQL cursor
         :return:
             None
         """
-        cursor.execute(
-            'INSERT OR IGNORE INTO cours(idMatiere, nomMatiere) VALUES("'
-            + course_id
-            + '", "'
-            + course_name
-            + '");'
-        )
-        id = cursor.execute('SELECT idCours FROM cours ' +
-                       'WHERE idMatiere="' + course_id + '" ' +
-                       'AND nomMatiere="' + course_name + '"').fetchone()[0]
-        cursor.execute(
-            'INSERT OR IGNORE INTO lienCoSe(idSession, idCours) VALUES(' +
-            self.last_session +
-            ', ' +
-            str(id) +
-            ');'
-        )
+        parameters = [(session_id,) for session_id in sessions_ids]
+        for table in ("lienSaSe", "lienPSe", "lienCoSe", "lienClSe"):
+            cursor.executemany('DELETE FROM ' + table + ' WHERE idSession = ?;', parameters)
+        cursor.executemany('DELETE FROM sessions WHERE id = ?;', parameters)
+        cursor.executemany('DELETE FROM intervalles WHERE id = ?;', parameters)
 
-    def add_class(self, school_class: str, cursor:sqlite3.Cursor):
+    def remove_class(self, school_class: str, cursor: sqlite3.Cursor):
         """
-            Adds a school class to the database
+            Removes a school class and the sessions no other class shares from the database
         :param school_class: The desired school class
         :param cursor: The SQL cursor
         :return:
             None
         """
-        cursor.execute('INSERT OR IGNORE INTO classes(nomClasse) VALUES("' +
-                           school_class + '");')
-        id = cursor.execute('SELECT idClasse FROM classes WHERE nomClasse="' + school_class + '"').fetchone()[0]
-        cursor.execute(
-            'INSERT OR IGNORE INTO lienClSe(idSession, idClasse) VALUES(' +
-            self.last_session +
-            ', ' +
-            str(id) +
-            ');'
-        )
+        cursor.execute('DELETE FROM lienClSe WHERE idClasse IN ' +
+                       '(SELECT idClasse FROM classes WHERE nomClasse = ?);', (school_class,))
+        self.remove_sessions([session_id for (session_id,) in cursor.execute(
+            'SELECT id FROM sessions WHERE id NOT IN (SELECT idSession FROM lienClSe);'
+        ).fetchall()], cursor)
+        cursor.execute('DELETE FROM classes WHERE nomClasse = ?;', (school_class,))
+        cursor.execute('DELETE FROM changements WHERE nomClasse = ?;', (school_class,))
 
-    def add_session(self, session: hyperapi.Lesson, cursor:sqlite3.Cursor):
+    @staticmethod
+    def prune(cursor: sqlite3.Cursor):
         """
-            Adds a session to the database
-        :param session: The desired session
+            Removes the rooms, teachers and courses no session refers to anymore
         :param cursor: The SQL cursor
         :return:
             None
         """
-        cursor.execute(
-            """INSERT OR IGNORE INTO sessions(debut, fin, """ +
-            """typeCours) VALUES (\'"""
-            + session.dateDebut
-            + """ """
-            + session.start_db
-            + """\', \'"""
-            + session.dateFin
-            + """ """
-            + session.end_db
-            + """\', \'"""
-            + session.typeCours
-            + """\');"""
-        )
-        self.last_session = str(cursor.lastrowid)
+        cursor.execute('DELETE FROM salles WHERE idSalle NOT IN (SELECT idSalle FROM lienSaSe);')
+        cursor.execute('DELETE FROM profs WHERE idProf NOT IN (SELECT idProf FROM lienPSe);')
+        cursor.execute('DELETE FROM cours WHERE idCours NOT IN (SELECT idCours FROM lienCoSe);')
 
     def get_sql(self, school_class: str, **kwargs):
         """
@@ -317,80 +1431,194 @@ class DatabaseManager:
         :return:
             A JSON array or None
         """
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
-        sessions_list = []
+        begin, end = get_bounds(**kwargs)
+        with self.pool.connection() as connection, \
+                METRICS.timer("hyperapi_query_seconds", query="sessions"):
+            sessions_list = [to_lesson(row) for row in connection.execute(
+                SESSIONS_QUERY, (school_class, begin, end))]
+
+        # JSON building
+        return json.dumps(sessions_list, default=hyperapi.Lesson.as_dict)
 
+    def get_free_rooms(self, day: datetime.date, begin: datetime.time, end: datetime.time):
+        """
+            Lists the rooms no session uses during a time range
+        :param day: The desired date
+        :param begin: The start of the time range
+        :param end: The end of the time range
+        :return:
+            A list of room names
+        """
+        with self.pool.connection() as connection, \
+                METRICS.timer("hyperapi_query_seconds", query="free_rooms"):
+            return [room for (room,) in connection.execute(FREE_ROOMS_QUERY, (
+                hyperapi.Lesson.DEFAULTS['numeroSalle'],
+                to_minutes("{} {}".format(day, end.strftime("%H:%M:%S"))),
+                to_minutes("{} {}".format(day, begin.strftime("%H:%M:%S")))))]
+
+    def get_busy_times(self, teacher: str, **kwargs):
+        """
+            Lists the times a teacher has sessions during a period
+        :param teacher: The name of the teacher, as in the nomProf of the lessons
+        :param kwargs: Desired bounds, see get_bounds()
+        :return:
+            A list of (debut, fin) tuples, as YYYY-MM-DD HH:MM:SS
+        """
+        begin, end = get_bounds(**kwargs)
         if "week" in kwargs:
-            iso_date = kwargs.get("week")
-            week = isoweek.Week(
-                int(iso_date.split("-W")[0]), int(iso_date.split("-W")[1])
-            )
-            begin = week.monday().strftime("%Y-%m-%d")
-            end = week.sunday().strftime("%Y-%m-%d")
-        else:
-            day = kwargs.get("day")
-            begin = str(day.strftime("%Y-%m-%d"))
-            end = str((day + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
-
-        sessions_results = cursor.execute(
-            'SELECT sessions.debut,' +
-            'sessions.fin,' +
-            'cours.idMatiere,' +
-            'cours.nomMatiere,' +
-            'sessions.id,' +
-            'salles.numeroSalle,' +
-            'sessions.typeCours ' +
-            'FROM sessions ' +
-
-            'INNER JOIN lienClSe ON lienClSe.idSession = sessions.id ' +
-            'INNER JOIN classes ON classes.idClasse = lienClSe.idClasse ' +
-
-            'INNER JOIN lienSaSe ON lienSaSe.idSession = sessions.id ' +
-            'INNER JOIN salles ON salles.idSalle = lienSaSe.idSalle ' +
-
-            'INNER JOIN lienCoSe ON lienCoSe.idSession = sessions.id ' +
-            'INNER JOIN cours ON cours.idCours = lienCoSe.idCours ' +
-
-            'WHERE classes.nomClasse = "' +
-            school_class +
-            '" AND sessions.debut BETWEEN "' +
-            begin +
-            '" AND "' +
-            end +
-            '" ORDER BY debut;'
-        ).fetchall()
-
-        for session in sessions_results:
-            profs = cursor.execute('SELECT profs.nomProf FROM sessions ' +
-                                   'INNER JOIN lienPSe ON lienPSe.idSession = sessions.id ' +
-                                   'INNER JOIN profs ON lienPSe.idProf = profs.idProf ' +
-                                   'WHERE sessions.id = ' + str(session[4])).fetchall()
-            new_str = ""
-            for o in profs:
-                new_str += o[0] + ", "
-            new_str = new_str[:-2]
-            try:
-                sessions_list.append(
-                    hyperapi.Lesson(
-                        idMatiere=session[2],
-                        nomMatiere=session[3],
-                        nomProf=new_str,
-                        typeCours=session[6],
-                        numeroSalle=session[5],
-                        dateDebut=session[0].split()[0],
-                        dateFin=session[1].split()[0],
-                        heureDebut=datetime.datetime.strptime(
-                            session[0].split()[1], "%H:%M:%S"
-                            ).strftime("%Hh%M"),
-                        heureFin=datetime.datetime.strptime(
-                            session[1].split()[1], "%H:%M:%S"
-                            ).strftime("%Hh%M"),
-                    )
-                )
-            except IndexError as e:
-                LOGGER.exception("%s : day is work-free")
-                pass
+            # The bounds of a week are its Monday and its Sunday
+            end = (datetime.date.fromisoformat(end) + datetime.timedelta(days=1)).isoformat()
+        with self.pool.connection() as connection, \
+                METRICS.timer("hyperapi_query_seconds", query="busy_teacher"):
+            return connection.execute(BUSY_TEACHER_QUERY, (
+                teacher, to_minutes(end + " 00:00:00"),
+                to_minutes(begin + " 00:00:00"))).fetchall()
 
-        # JSON building
-        return json.dumps(sessions_list, default=lambda o: o.__dict__)
+    def get_response(self, school_class: str, **kwargs):
+        """
+            Retrieves the body of the API response for a period, from its snapshot if any
+        :param school_class: The desired school class
+        :param kwargs: Desired bounds
+        :return:
+            bytes
+        """
+        # Until the timetable of a new generation is loaded, the database answers
+        if self.timetable is not None and self.timetable.generation == self.get_generation():
+            begin, end = get_bounds(**kwargs)
+            with METRICS.timer("hyperapi_query_seconds", query="timetable"):
+                return ("[" + ",".join(self.timetable.lookup(
+                    school_class, to_minutes(begin + " 00:00:00"),
+                    to_minutes(end + " 00:00:00"))) + "]\n").encode()
+        with self.pool.connection() as connection:
+            if self.snapshots:
+                with METRICS.timer("hyperapi_query_seconds", query="snapshot"):
+                    snapshot = connection.execute(
+                        'SELECT corps FROM snapshots WHERE nomClasse = ? AND periode = ?;',
+                        (school_class, get_period(**kwargs))).fetchone()
+                if snapshot is not None:
+                    return snapshot[0]
+            begin, end = get_bounds(**kwargs)
+            with METRICS.timer("hyperapi_query_seconds", query="sessions"):
+                return encode(connection.execute(SESSIONS_QUERY, (school_class, begin, end)))
+
+    def get_changes(self, school_class: str, since: int):
+        """
+            Retrieves the changes of the timetable of a school class since a generation.
+            Each session appears once, with its overall change : a session added then
+            modified was added, a session added then removed does not appear.
+        :param school_class: The desired school class
+        :param since: The generation the client has
+        :return:
+            A dict with the current generation, the lessons of the added (ajouts) and
+            modified (modifications) sessions and the UIDs of the removed ones
+            (suppressions), or None if the changes since this generation are not kept or
+            if the generation is ahead of the database, which was then rebuilt
+        """
+        with self.pool.connection() as connection, \
+                METRICS.timer("hyperapi_query_seconds", query="changes"):
+            generation = connection.execute(
+                'SELECT valeur FROM meta WHERE cle = "generation";').fetchone()[0]
+            changes = {"generation": generation, "ajouts": [], "modifications": [],
+                       "suppressions": []}
+            if since > generation or since < generation - self.history:
+                return None
+            if since == generation:
+                return changes
+
+            natures = {}
+            for uid, nature in connection.execute(
+                    'SELECT uid, nature FROM changements ' +
+                    'WHERE nomClasse = ? AND generation > ? ORDER BY generation;',
+                    (school_class, since)):
+                first = natures.get(uid, (nature,))[0]
+                natures[uid] = (first, nature)
+            kinds = {}
+            for uid, (first, last) in natures.items():
+                if last == "suppression":
+                    if first != "ajout":
+                        changes["suppressions"].append(uid)
+                else:
+                    kinds[uid] = "ajouts" if first == "ajout" else "modifications"
+
+            uids = list(kinds)
+            # Stay below the limit of the number of parameters of a query
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                for row in connection.execute(changed_query(len(chunk)),
+                                              [school_class] + chunk):
+                    changes[kinds[row[7]]].append(to_lesson(row).as_dict())
+        return changes
+
+    def load_timetable(self):
+        """
+            Lists the sessions of every class for the in-memory timetable
+        :return:
+            A list of (school class, start in minutes since the epoch, JSON lesson) tuples,
+            sorted by school class then start
+        """
+        with self.pool.connection() as connection, \
+                METRICS.timer("hyperapi_query_seconds", query="load_timetable"):
+            return [(row[10], to_minutes(row[0]), encode_lesson(row))
+                    for row in connection.execute(TIMETABLE_QUERY)]
+
+    def materialize(self, school_classes: list, cursor: sqlite3.Cursor):
+        """
+            Replaces the snapshots of school classes by the responses of every week
+            and day they have sessions in, and records whether they are up to date
+        :param school_classes: The desired school classes
+        :param cursor: The SQL cursor
+        :return:
+            None
+        """
+        for school_class in school_classes:
+            start = time.perf_counter()
+            cursor.execute('DELETE FROM snapshots WHERE nomClasse = ?;', (school_class,))
+            cursor.execute('UPDATE classes SET instantane = ? WHERE nomClasse = ?;',
+                           (int(self.snapshots), school_class))
+            if not self.snapshots:
+                continue
+
+            periods = {}
+            for row in cursor.execute(
+                    SESSIONS_QUERY, (school_class, "0000-00-00", "9999-12-31")).fetchall():
+                periods.setdefault(row[0][:10], []).append(row)
+                day = datetime.date.fromisoformat(row[0][:10])
+                # Weeks are requested from monday to sunday midnight
+                if day.isoweekday() != 7:
+                    year, week = day.isocalendar()[:2]
+                    periods.setdefault("{}-W{:02d}".format(year, week), []).append(row)
+            cursor.executemany(
+                'INSERT INTO snapshots(nomClasse, periode, corps) VALUES (?, ?, ?);',
+                [(school_class, period, encode(rows)) for period, rows in periods.items()])
+            METRICS.set("hyperapi_refresh_class_seconds", time.perf_counter() - start,
+                        classe=school_class, stage="materialize")
+
+    def stream_sessions(self, school_classes: list, begin: datetime.date,
+                        end: datetime.date, chunk_size: int = 500):
+        """
+            Streams the sessions of several school classes over a date range with a
+            single query, one JSON lesson with its school class per line
+        :param school_classes: The desired school classes
+        :param begin: The first day of the range
+        :param end: The last day of the range
+        :param chunk_size: The number of lessons per yielded chunk
+        :return:
+            A generator of bytes
+        """
+        quote = json.encoder.encode_basestring_ascii
+        with self.pool.connection() as connection:
+            with METRICS.timer("hyperapi_query_seconds", query="bulk"):
+                cursor = connection.execute(
+                    bulk_query(len(school_classes)),
+                    tuple(school_classes) + (begin.strftime("%Y-%m-%d"),
+                                             (end + datetime.timedelta(days=1))
+                                             .strftime("%Y-%m-%d")))
+            try:
+                rows = cursor.fetchmany(chunk_size)
+                while rows:
+                    yield "".join('{"groupe":' + quote(row[10]) + ',' +
+                                  encode_lesson(row)[1:] + '\n' for row in rows).encode()
+                    rows = cursor.fetchmany(chunk_size)
+            finally:
+                # An unfinished statement would keep its read transaction open
+                cursor.close()
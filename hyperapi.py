@@ -1,41 +1,117 @@
 """
     Downloads and scrapes a .ical file
 """
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from functools import lru_cache
+import gzip
+import hashlib
+import json
+import os
 import re
-from icalendar import Calendar
+import time
+from icalendar import Calendar, Event
 import pytz
 import requests
+from requests.adapters import HTTPAdapter
 
 REGEX_ID = re.compile("^M[0-9]+")
 REGEX_TEACHERS = re.compile("M\.|Mme|_enseignant inconnu_")
 REGEX_TYPE = re.compile("TP_*|TD_*|Cours_*")
 REGEX_DS = re.compile("DS_*")
+SUMMARY_CACHE_SIZE = 4096
+
+SUMMER_TIME = pytz.UTC.localize(datetime(2020, 3, 29))
+SUMMER_OFFSET = timedelta(hours=2)
+WINTER_OFFSET = timedelta(hours=1)
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 1.0
+
+# Version of the lessons produced by event_filter, to bump when they change so that
+# the lessons stored by a CalendarStore are parsed again
+PARSER_VERSION = 1
+
+Validators = namedtuple("Validators", ("etag", "last_modified", "digest"))
+# Validators of the last conditional download of each URL
+VALIDATORS = {}
 
 
 class Lesson:
     """
         An event scrapped from the .ical file
     """
+    __slots__ = ('idMatiere', 'nomMatiere', 'nomProf', 'typeCours', 'numeroSalle',
+                 'dateDebut', 'dateFin', 'heureDebut', 'start_db', 'heureFin', 'end_db',
+                 'listeDevoirs', 'uid')
+    # Values of the missing fields
+    DEFAULTS = {
+        'idMatiere': "ID inconnu",
+        'nomMatiere': "Nom inconnu",
+        'nomProf': "Enseignant inconnu",
+        'typeCours': "Type inconnu",
+        'numeroSalle': "Salle inconnue",
+        'dateDebut': "Date inconnue",
+        'dateFin': "Date inconnue",
+        'heureDebut': "Heure inconnue",
+        'heureFin': "Heure inconnue",
+    }
 
     def __init__(self, **kwargs):
         """
             Initializes the object variables
         :param kwargs: Constructor's arguments
         """
-
-        self.idMatiere = kwargs.get('idMatiere') or "ID inconnu"
-        self.nomMatiere = kwargs.get('nomMatiere') or "Nom inconnu"
-        self.nomProf = kwargs.get('nomProf') or "Enseignant inconnu"
-        self.typeCours = kwargs.get('typeCours') or "Type inconnu"
-        self.numeroSalle = kwargs.get('numeroSalle') or "Salle inconnue"
-        self.dateDebut = kwargs.get('dateDebut') or "Date inconnue"
-        self.dateFin = kwargs.get('dateFin') or "Date inconnue"
-        self.heureDebut = kwargs.get('heureDebut') or "Heure inconnue"
+        defaults = self.DEFAULTS
+        self.idMatiere = kwargs.get('idMatiere') or defaults['idMatiere']
+        self.nomMatiere = kwargs.get('nomMatiere') or defaults['nomMatiere']
+        self.nomProf = kwargs.get('nomProf') or defaults['nomProf']
+        self.typeCours = kwargs.get('typeCours') or defaults['typeCours']
+        self.numeroSalle = kwargs.get('numeroSalle') or defaults['numeroSalle']
+        self.dateDebut = kwargs.get('dateDebut') or defaults['dateDebut']
+        self.dateFin = kwargs.get('dateFin') or defaults['dateFin']
+        self.heureDebut = kwargs.get('heureDebut') or defaults['heureDebut']
         self.start_db = kwargs.get('start_db') or ""
-        self.heureFin = kwargs.get('heureFin') or "Heure inconnue"
+        self.heureFin = kwargs.get('heureFin') or defaults['heureFin']
         self.end_db = kwargs.get('end_db') or ""
         self.listeDevoirs = ""
+        self.uid = kwargs.get('uid') or ""
+
+    def as_dict(self):
+        """
+            Lists the fields of the lesson, as serialized by the API
+
+        :return:
+            dict
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def as_tuple(self):
+        """
+            Lists the values of the fields of the lesson, in the order of __slots__,
+            as a compact record to send to another process
+
+        :return:
+            tuple
+        """
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, record: tuple):
+        """
+            Rebuilds a lesson from the record made by as_tuple()
+
+        :param record: The values of the fields of the lesson
+        :return:
+            Lesson
+        """
+        lesson = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, record):
+            setattr(lesson, name, value)
+        return lesson
 
     def is_empty(self):
         """
@@ -46,16 +122,203 @@ class Lesson:
         """
         return self.nomMatiere == '' and self.nomProf == '' and (self.typeCours == '' or self.typeCours == 'Divers')
 
+    def fingerprint(self):
+        """
+            Digests the stored content of the event, to detect modified events
 
-def scrape(calendar: str):
+        :return:
+            str
+        """
+        return hashlib.sha1("\x1f".join((
+            self.dateDebut, self.start_db, self.dateFin, self.end_db,
+            self.typeCours, self.numeroSalle, self.nomProf,
+            self.idMatiere, self.nomMatiere
+        )).encode()).hexdigest()
+
+
+class CalendarStore:
+    """
+        An on-disk store of the downloaded .ical files and of their lessons.
+        Each content is compressed once under its SHA-256 digest, and the history of
+        the digests of each URL is kept so that past calendars can be replayed.
+    """
+    def __init__(self, path: str):
+        """
+            Initializes the store, creating its directories
+        :param path: The directory of the store
+        """
+        self.path = path
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(path, "refs"), exist_ok=True)
+
+    @staticmethod
+    def digest(text: str):
+        """
+            Computes the key of a calendar content
+        :param text: The content of the .ical file
+        :return:
+            str
+        """
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def object_path(self, digest: str, kind: str):
+        """
+            Locates a stored object
+        :param digest: The digest of the calendar content
+        :param kind: The file extension of the object
+        :return:
+            str
+        """
+        return os.path.join(self.path, "objects", digest[:2], digest + kind)
+
+    def ref_path(self, url: str):
+        """
+            Locates the history of a URL
+        :param url: The .ical file URL
+        :return:
+            str
+        """
+        return os.path.join(self.path, "refs", hashlib.sha1(url.encode()).hexdigest() + ".log")
+
+    def write(self, path: str, data: bytes):
+        """
+            Compresses data into a file, which only appears once complete
+        :param path: The path of the file
+        :param data: The uncompressed content
+        :return:
+            None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def save(self, url: str, text: str, moment: str):
+        """
+            Stores a downloaded calendar and records it in the history of its URL
+        :param url: The .ical file URL
+        :param text: The content of the .ical file
+        :param moment: The download time, as YYYY-MM-DD HH:MM:SS
+        :return:
+            The digest of the content
+        """
+        digest = self.digest(text)
+        path = self.object_path(digest, ".ics.gz")
+        if not os.path.exists(path):
+            self.write(path, text.encode())
+        history = self.history(url)
+        if not history or history[-1][1] != digest:
+            with open(self.ref_path(url), "a") as ref:
+                ref.write("{} {}\n".format(moment, digest))
+        return digest
+
+    def history(self, url: str):
+        """
+            Lists the contents a URL had
+        :param url: The .ical file URL
+        :return:
+            A list of (moment, digest) tuples, oldest first
+        """
+        try:
+            with open(self.ref_path(url)) as ref:
+                return [tuple(line.rstrip("\n").rsplit(" ", 1)) for line in ref if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def load(self, url: str, moment: str = None):
+        """
+            Reads a stored calendar
+        :param url: The .ical file URL
+        :param moment: The time the calendar is wanted as of, as YYYY-MM-DD HH:MM:SS,
+            None for the last stored one
+        :return:
+            str, or None if no calendar of this URL was stored by then
+        """
+        digests = [digest for saved, digest in self.history(url)
+                   if moment is None or saved <= moment]
+        if not digests:
+            return None
+        with gzip.open(self.object_path(digests[-1], ".ics.gz"), "rb") as file:
+            return file.read().decode()
+
+    def get_lessons(self, text: str):
+        """
+            Reads the lessons stored for a calendar content
+        :param text: The content of the .ical file
+        :return:
+            A Lesson list, or None if they were not stored
+        """
+        path = self.object_path(self.digest(text), ".{}.json.gz".format(PARSER_VERSION))
+        try:
+            with gzip.open(path, "rb") as file:
+                return [Lesson.from_tuple(record) for record in json.loads(file.read())]
+        except FileNotFoundError:
+            return None
+
+    def put_lessons(self, text: str, lessons: list):
+        """
+            Stores the lessons of a calendar content
+        :param text: The content of the .ical file
+        :param lessons: Its Lesson list
+        :return:
+            None
+        """
+        self.write(self.object_path(self.digest(text), ".{}.json.gz".format(PARSER_VERSION)),
+                   json.dumps([lesson.as_tuple() for lesson in lessons],
+                              separators=(",", ":")).encode())
+
+
+def create_session(pool_size: int = DEFAULT_WORKERS):
+    """
+        Creates an HTTP session keeping up to pool_size connections alive per host
+    :param pool_size: The connection pool size, should match the worker count
+    :return:
+        A requests.Session
     """
-    Scrapes .ical file directly from URL
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = create_session()
+
+
+def scrape(calendar: str, timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES,
+           session: requests.Session = None):
+    """
+    Scrapes .ical file directly from URL, parsing it while it is being downloaded
+    and retrying on network and HTTP errors. The builds of the database download
+    the whole files instead, which they compare, store and may parse in other processes
 
     :param calendar: The .ical file URL
+    :param timeout: The timeout of the connection and of each read, in seconds
+    :param retries: The number of attempts after the first one
+    :param session: The HTTP session to use, defaults to the shared SESSION
     :return:
         A Lesson array
     """
-    calendar = get_calendar(calendar)
+    attempt = 0
+    while True:
+        try:
+            return list(scrape_stream(calendar, timeout, session))
+        except requests.RequestException:
+            if attempt >= retries:
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+            attempt += 1
+
+
+def parse(text: str):
+    """
+    Scrapes an already downloaded .ical file
+
+    :param text: The content of the .ical file
+    :return:
+        A Lesson array
+    """
+    calendar = Calendar.from_ical(text)
     lesson_list = []
 
     for component in calendar.walk():
@@ -65,94 +328,234 @@ def scrape(calendar: str):
     return lesson_list
 
 
-def event_filter(event: dict):
+def parse_records(text: str):
     """
-        Scrapes the .ical file and builds a Lesson object directly from it
-    :param event: The text of the .ical file
+    Scrapes an already downloaded .ical file into compact lesson records,
+    to be run by another process
+
+    :param text: The content of the .ical file
     :return:
-        A Lesson object fully initialized
+        A list of tuples, see Lesson.as_tuple()
     """
-    event_type = event_id = event_name = event_teacher = event_room = event_start_date = \
-        event_end_date = event_start_hour = event_end_hour = event_start_db = \
-        event_end_db = ""
+    return [lesson.as_tuple() for lesson in parse_lines(text.splitlines())]
 
-    header = event.get("SUMMARY").split(" - ")
 
-    regex_result = list(filter(REGEX_ID.match, header))
-    if regex_result:
-        event_id = regex_result[0].split(' ')[0]
-        event_name = regex_result[0].split(' ')[1]
-    else:
-        event_name = header[0]
+def parse_calendars(texts: list, processes: int):
+    """
+    Scrapes several already downloaded .ical files in a pool of processes
+
+    :param texts: The contents of the .ical files
+    :param processes: The number of processes
+    :return:
+        A generator of (Lesson list, exception) tuples, in the order of texts.
+        The list is None if the file could not be parsed.
+    """
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(parse_records, text) for text in texts]
+        for future in futures:
+            try:
+                yield [Lesson.from_tuple(record) for record in future.result()], None
+            except Exception as exception:
+                yield None, exception
+
+
+def scrape_stream(calendar: str, timeout: float = DEFAULT_TIMEOUT,
+                  session: requests.Session = None):
+    """
+    Scrapes .ical file from URL while it is being downloaded
+
+    :param calendar: The .ical file URL
+    :param timeout: The timeout of the connection and of each read, in seconds
+    :param session: The HTTP session to use, defaults to the shared SESSION
+    :return:
+        A generator of Lesson objects
+    """
+    session = session or SESSION
+    with session.get(calendar, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        encoding = response.encoding or "utf-8"
+        yield from parse_lines(line.decode(encoding) for line in response.iter_lines())
+
+
+def parse_lines(lines):
+    """
+    Scrapes the lines of a .ical file one VEVENT at a time, without building
+    the whole calendar
+
+    :param lines: An iterable of the lines of the .ical file
+    :return:
+        A generator of Lesson objects
+    """
+    event_lines = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        if event_lines is None:
+            if line == "BEGIN:VEVENT":
+                event_lines = [line]
+            continue
+        event_lines.append(line)
+        if line == "END:VEVENT":
+            yield event_filter(Event.from_ical("\r\n".join(event_lines)))
+            event_lines = None
+
 
-    regex_result = list(filter(REGEX_TEACHERS.match, header))
-    if regex_result:
-        event_teacher = regex_result[0].strip()
+@lru_cache(maxsize=SUMMARY_CACHE_SIZE)
+def parse_summary(summary: str):
+    """
+        Splits an event SUMMARY into its course, teachers and type in a single pass.
+        Timetables repeat the same summaries, so the results are memoized.
+    :param summary: The SUMMARY of the event
+    :return:
+        An (idMatiere, nomMatiere, nomProf, typeCours) tuple
+    """
+    header = summary.split(" - ")
+    event_id = event_name = event_teacher = event_type = None
+    event_ds = None
 
-    regex_result = list(filter(REGEX_TYPE.match, header))
-    if regex_result:
-        event_type = regex_result[0]
+    # The first part matching each pattern wins, a part may match several of them
+    for part in header:
+        if event_id is None and REGEX_ID.match(part):
+            words = part.split(' ')
+            event_id, event_name = words[0], words[1]
+        if event_teacher is None and REGEX_TEACHERS.match(part):
+            event_teacher = part.strip()
+        if event_type is None and REGEX_TYPE.match(part):
+            event_type = part
+        if event_ds is None and REGEX_DS.match(part):
+            event_ds = part
 
-    regex_result = list(filter(REGEX_DS.match, header))
-    if regex_result:
-        event_type = regex_result[0]
+    if event_id is None:
+        event_id, event_name = "", header[0]
+    if event_ds is not None:
+        event_type = event_ds
         event_name += " : " + header[len(header) - 2]
+    return event_id, event_name, event_teacher or "", event_type or ""
 
-    try:
-        event_room = event.get("LOCATION")
-    except KeyError:
-        pass
-
-    event_start_date = event.get("DTSTART").dt.strftime("%Y-%m-%d")
-    event_end_date = event.get("DTEND").dt.strftime("%Y-%m-%d")
-    if len(str(event.get("DTSTART").dt).split(' ')) != 1:
-        utc = pytz.UTC
-        if event.get("DTEND").dt > utc.localize(datetime(2020, 3, 29)):
-            event_start_hour = (
-                event.get("DTSTART").dt +
-                timedelta(hours=2)).strftime("%Hh%M")
-            event_start_db = (
-                event.get("DTSTART").dt +
-                timedelta(hours=2)).strftime("%H:%M:%S")
-            event_end_hour = (
-                event.get("DTEND").dt +
-                timedelta(hours=2)).strftime("%Hh%M")
-            event_end_db = (
-                event.get("DTEND").dt +
-                timedelta(hours=2)).strftime("%H:%M:%S")
-        else:
-            event_start_hour = (
-                event.get("DTSTART").dt +
-                timedelta(hours=1)).strftime("%Hh%M")
-            event_start_db = (
-                event.get("DTSTART").dt +
-                timedelta(hours=1)).strftime("%H:%M:%S")
-            event_end_hour = (
-                event.get("DTEND").dt +
-                timedelta(hours=1)).strftime("%Hh%M")
-            event_end_db = (
-                event.get("DTEND").dt +
-                timedelta(hours=1)).strftime("%H:%M:%S")
+
+def event_filter(event: dict):
+    """
+        Scrapes the .ical file and builds a Lesson object directly from it
+    :param event: The text of the .ical file
+    :return:
+        A Lesson object fully initialized
+    """
+    event_start_hour = event_end_hour = event_start_db = event_end_db = ""
+
+    event_id, event_name, event_teacher, event_type = parse_summary(str(event.get("SUMMARY", "")))
+
+    start = event.get("DTSTART").dt
+    end = event.get("DTEND").dt
+    event_start_date = "{:04d}-{:02d}-{:02d}".format(start.year, start.month, start.day)
+    event_end_date = "{:04d}-{:02d}-{:02d}".format(end.year, end.month, end.day)
+    if isinstance(start, datetime):
+        # HyperPlanning times are UTC, displayed in French summer or winter time
+        offset = SUMMER_OFFSET if end > SUMMER_TIME else WINTER_OFFSET
+        start += offset
+        end += offset
+        event_start_hour = "{:02d}h{:02d}".format(start.hour, start.minute)
+        event_start_db = "{:02d}:{:02d}:{:02d}".format(start.hour, start.minute, start.second)
+        event_end_hour = "{:02d}h{:02d}".format(end.hour, end.minute)
+        event_end_db = "{:02d}:{:02d}:{:02d}".format(end.hour, end.minute, end.second)
 
     return Lesson(idMatiere=event_id,
                   nomMatiere=event_name,
                   nomProf=event_teacher,
                   typeCours=event_type,
-                  numeroSalle=event_room,
+                  numeroSalle=event.get("LOCATION"),
                   dateDebut=event_start_date,
                   dateFin=event_end_date,
                   heureDebut=event_start_hour,
                   start_db=event_start_db,
                   heureFin=event_end_hour,
-                  end_db=event_end_db)
+                  end_db=event_end_db,
+                  uid=str(event.get("UID") or ""))
+
+
+def download(url: str, timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES,
+             session: requests.Session = None, conditional: bool = False):
+    """
+        Downloads the .ical file from URL, retrying on network and HTTP errors
+
+    :param url: The .ical file URL
+    :param timeout: The timeout of each attempt, in seconds
+    :param retries: The number of attempts after the first one
+    :param session: The HTTP session to use, defaults to the shared SESSION
+    :param conditional: Whether to skip the calendar if it did not change since
+        the last conditional download of this URL
+    :return:
+        str, or None if conditional and the calendar did not change
+    """
+    session = session or SESSION
+    known = VALIDATORS.get(url) if conditional else None
+    headers = {}
+    if known is not None:
+        if known.etag:
+            headers["If-None-Match"] = known.etag
+        if known.last_modified:
+            headers["If-Modified-Since"] = known.last_modified
+    attempt = 0
+    while True:
+        try:
+            response = session.get(url, timeout=timeout, headers=headers)
+            if known is not None and response.status_code == 304:
+                return None
+            response.raise_for_status()
+            if not conditional:
+                return response.text
+            digest = hashlib.sha256(response.content).hexdigest()
+            VALIDATORS[url] = Validators(response.headers.get("ETag"),
+                                         response.headers.get("Last-Modified"),
+                                         digest)
+            return None if known is not None and known.digest == digest else response.text
+        except requests.RequestException:
+            if attempt >= retries:
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+            attempt += 1
+
+
+def fetch_calendars(urls: list, workers: int = DEFAULT_WORKERS, **kwargs):
+    """
+        Downloads several .ical files concurrently over a shared connection pool
+
+    :param urls: The .ical file URLs
+    :param workers: The maximum number of simultaneous downloads
+    :param kwargs: Download options, see download(). The session's pool should
+        hold at least as many connections as there are workers
+    :return:
+        A generator of (url, text, exception) tuples, in completion order.
+        text is None if the download failed or, when conditional, if the
+        calendar did not change.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, url, **kwargs): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except requests.RequestException as exception:
+                yield futures[future], None, exception
+
+
+def forget(url: str):
+    """
+        Forgets the validators of a URL so its next conditional download is complete
+
+    :param url: The .ical file URL
+    :return:
+        None
+    """
+    VALIDATORS.pop(url, None)
 
 
-def get_calendar(url: str):
+def get_calendar(url: str, **kwargs):
     """
         Downloads the .ical file from URL
 
     :param url: The .ical file URL
+    :param kwargs: Download options, see download()
     :return:
-        str
+        An icalendar.Calendar
     """
-    return Calendar.from_ical(requests.get(url).text)
+    return Calendar.from_ical(download(url, **kwargs))
@@ -2,13 +2,18 @@
     A simple HyperPlanning API since the official HyperPlanning
     website is dynamic and difficult to scrape
 """
-import json
+import hashlib
 from datetime import datetime, timedelta
 import logging
+import sqlite3
+import threading
+import time
 import flask
 from flask_cors import CORS
-from flask import jsonify, Flask
+from flask import Flask
+import cache
 import databasemanager
+import metrics
 from configparser import ConfigParser
 
 
@@ -16,13 +21,87 @@ PARSER = ConfigParser()
 PARSER.read('config/database.config')
 
 LOGGER = logging.getLogger("werkzeug")
-LOGGER.addHandler(logging.FileHandler("logs/connections.log", 'w'))
+LOGGER.addHandler(metrics.queue_handler(logging.FileHandler("logs/connections.log", 'a')))
 
 APP = Flask(__name__)
 CORS(APP)
 
-DB = databasemanager.DatabaseManager(PARSER.get('planning', 'path'))
-DB.build()
+# Without the embedded refresher, the database is built by refresher.py and the
+# app can be served by any number of WSGI processes and threads
+REFRESH = PARSER.getboolean('server', 'refresh', fallback=True)
+DB = databasemanager.from_config(PARSER, readonly=not REFRESH)
+if REFRESH:
+    # The last persisted database is served while the first build runs
+    INTERVAL = PARSER.getfloat('planning', 'interval', fallback=3600.0)
+    JITTER = PARSER.getfloat('planning', 'jitter', fallback=0.0)
+    threading.Thread(target=DB.refresh_forever, args=(INTERVAL, 0.0, JITTER), daemon=True).start()
+elif DB.timetable is not None:
+    # The timetable of each generation built by the refresher is loaded off the requests
+    threading.Thread(target=DB.watch_forever, daemon=True).start()
+
+CACHE = cache.ResponseCache(PARSER.getint('cache', 'size', fallback=1024))
+
+METRICS = metrics.METRICS
+METRICS.declare("hyperapi_request_seconds", "histogram",
+                "Duration of the requests, by endpoint", metrics.LATENCY_BUCKETS)
+METRICS.declare("hyperapi_requests_total", "counter", "Requests, by endpoint and status")
+METRICS.declare("hyperapi_cache_hits_total", "counter", "Responses served from the cache")
+METRICS.declare("hyperapi_cache_misses_total", "counter",
+                "Responses built because they were not cached")
+METRICS.declare("hyperapi_cache_hit_ratio", "gauge", "Share of the responses served from the cache")
+METRICS.declare("hyperapi_generation", "gauge", "Generation of the served database")
+METRICS.declare("hyperapi_data_age_seconds", "gauge",
+                "Time since the data was last checked against HyperPlanning")
+METRICS.declare("hyperapi_pool_connections_opened_total", "counter",
+                "Database connections opened by the pool")
+METRICS.declare("hyperapi_timetable_lessons", "gauge",
+                "Lessons loaded in the in-memory timetable")
+
+
+def get_state():
+    """
+    Reads the generation of the served database and the age of its data.
+
+    :return:
+        A dict of the generation, update and check dates, age in seconds and readiness
+    """
+    try:
+        state = DB.get_state()
+    except (sqlite3.Error, OSError):
+        state = {"generation": None, "miseAJour": None, "verification": None}
+    refreshed = state["verification"] or state["miseAJour"]
+    state["age"] = None if refreshed is None else \
+        (datetime.now() - datetime.strptime(refreshed, "%Y-%m-%d %H:%M:%S")).total_seconds()
+    state["ready"] = bool(state["generation"])
+    return state
+
+
+@APP.before_request
+def start_timer():
+    """
+    Notes when the request started, to measure its duration.
+
+    :return:
+        None
+    """
+    flask.g.start = time.perf_counter()
+
+
+@APP.after_request
+def record_request(response: flask.Response):
+    """
+    Records the duration and the status of the request, by endpoint.
+
+    :param response: The response to the request
+    :return:
+        The response
+    """
+    rule = flask.request.url_rule
+    endpoint = rule.rule if rule is not None else "unmatched"
+    METRICS.observe("hyperapi_request_seconds", time.perf_counter() - flask.g.start,
+                    endpoint=endpoint)
+    METRICS.increment("hyperapi_requests_total", endpoint=endpoint, status=response.status_code)
+    return response
 
 
 @APP.route('/', methods=['GET'])
@@ -36,6 +115,43 @@ def home():
     return flask.render_template('index.html')
 
 
+@APP.route('/api/health', methods=['GET'])
+def health():
+    """
+    Reports whether the API has data to serve, its generation and its age.
+    Answers with a 503 status until a first build has completed.
+
+    :return:
+        Json
+    """
+    state = get_state()
+    return flask.jsonify(state), 200 if state["ready"] else 503
+
+
+@APP.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Exposes the metrics of the API in the Prometheus text format: request latencies,
+    cache hits, database query times, data age, and the refresh stage durations
+    when the database is refreshed by this process.
+
+    :return:
+        str
+    """
+    state = get_state()
+    METRICS.set("hyperapi_cache_hits_total", CACHE.hits)
+    METRICS.set("hyperapi_cache_misses_total", CACHE.misses)
+    METRICS.set("hyperapi_cache_hit_ratio",
+                CACHE.hits / (CACHE.hits + CACHE.misses) if CACHE.hits + CACHE.misses else 0.0)
+    METRICS.set("hyperapi_generation", state["generation"] or 0)
+    if state["age"] is not None:
+        METRICS.set("hyperapi_data_age_seconds", state["age"])
+    METRICS.set("hyperapi_pool_connections_opened_total", DB.pool.opened)
+    if DB.timetable is not None:
+        METRICS.set("hyperapi_timetable_lessons", len(DB.timetable))
+    return flask.Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
 @APP.route('/api/s2/<group>/<period>', defaults={'bounds': None})
 @APP.route('/api/s2/<group>/<period>/<bounds>', methods=['GET'])
 def second_semester(group: str, period: str, bounds: str):
@@ -51,22 +167,128 @@ def second_semester(group: str, period: str, bounds: str):
         Json or str
     """
 
-    result = None
-
     if period == "today":
-        result = jsonify(json.loads(
-            DB.get_sql(group,
-                       day=(datetime.now() + timedelta(hours=1)).date())))
+        kwargs = {"day": (datetime.now() + timedelta(hours=1)).date()}
     elif period == "week":
-        result = jsonify(json.loads(
-            DB.get_sql(group,
-                       week=bounds)))
+        kwargs = {"week": bounds}
     elif period == "day":
-        result = jsonify(json.loads(
-            DB.get_sql(group,
-                       day=(datetime.strptime(bounds, "%Y-%m-%d").date()))))
+        kwargs = {"day": datetime.strptime(bounds, "%Y-%m-%d").date()}
+    else:
+        return "Error while parsing request, check request syntax"
+
+    generation = DB.get_generation()
+    key = (group,) + tuple(kwargs.items())
+    cached = CACHE.get(generation, key)
+    if cached is None:
+        body = DB.get_response(group, **kwargs)
+        cached = (body, hashlib.sha1(body).hexdigest())
+        CACHE.put(generation, key, cached)
+
+    # The ETag only depends on the content, unchanged timetables stay valid across builds
+    result = flask.Response(cached[0], mimetype="application/json")
+    result.set_etag(cached[1])
+    return result.make_conditional(flask.request)
+
+
+@APP.route('/api/changes/<group>', methods=['GET'])
+def changes(group: str):
+    """
+    Returns the lessons added, modified and removed since a generation of the database.
+    Expects an address of the following format:
+    hyperapi.hubday.fr/api/changes/<group>?since=<generation>
+    Answers with a 410 status when these changes are not kept anymore, or when the
+    generation is ahead of the rebuilt database, the whole timetable then has to be
+    downloaded again.
+
+    :param group: The group you want to get the changes of
+    :return:
+        Json or str
+    """
+    try:
+        since = int(flask.request.args["since"])
+    except (KeyError, ValueError):
+        return "Error while parsing request, check request syntax"
+
+    generation = DB.get_generation()
+    key = (group, "changes", since)
+    delta = CACHE.get(generation, key)
+    if delta is None:
+        delta = DB.get_changes(group, since)
+        if delta is None:
+            return "Changes since this generation are not available", 410
+        CACHE.put(generation, key, delta)
+    return flask.jsonify(delta)
+
+
+@APP.route('/api/rooms/free', methods=['GET'])
+def free_rooms():
+    """
+    Lists the rooms free during a time range. Expects an address of the following format:
+    hyperapi.hubday.fr/api/rooms/free?date=<YYYY-MM-DD>&begin=<HHhMM>&end=<HHhMM>
+
+    :return:
+        Json or str
+    """
+    try:
+        day = datetime.strptime(flask.request.args["date"], "%Y-%m-%d").date()
+        begin = datetime.strptime(flask.request.args["begin"], "%Hh%M").time()
+        end = datetime.strptime(flask.request.args["end"], "%Hh%M").time()
+    except (KeyError, ValueError):
+        return "Error while parsing request, check request syntax"
+
+    return flask.jsonify(DB.get_free_rooms(day, begin, end))
+
+
+@APP.route('/api/teachers/<teacher>/<period>/<bounds>', methods=['GET'])
+def busy_teacher(teacher: str, period: str, bounds: str):
+    """
+    Lists the times a teacher has lessons during a week or a day.
+    Expects an address of the following format:
+    hyperapi.hubday.fr/api/teachers/<teacher>/<period>/<bounds>
+
+    :param teacher: The teacher, as in the nomProf of the lessons
+    :param period: week or day
+    :param bounds: The ISO week like 2020-W03, or the date
+    :return:
+        Json or str
+    """
+    try:
+        if period == "week":
+            kwargs = {"week": bounds}
+            databasemanager.get_period(**kwargs)
+        elif period == "day":
+            kwargs = {"day": datetime.strptime(bounds, "%Y-%m-%d").date()}
+        else:
+            raise ValueError(period)
+    except (IndexError, ValueError):
+        return "Error while parsing request, check request syntax"
+
+    return flask.jsonify([{"debut": begin, "fin": end}
+                          for begin, end in DB.get_busy_times(teacher, **kwargs)])
+
+
+@APP.route('/api/s2/bulk', methods=['GET'])
+def bulk():
+    """
+    Streams the lessons of several groups over a date range, as one JSON lesson
+    per line with its group. Expects an address of the following format:
+    hyperapi.hubday.fr/api/s2/bulk?groups=<group>,<group>&begin=<YYYY-MM-DD>&end=<YYYY-MM-DD>
+
+    :return:
+        NDJSON or str
+    """
+    groups = [group for group in flask.request.args.get("groups", "").split(",") if group]
+    try:
+        begin = datetime.strptime(flask.request.args["begin"], "%Y-%m-%d").date()
+        end = datetime.strptime(flask.request.args["end"], "%Y-%m-%d").date()
+    except (KeyError, ValueError):
+        groups = None
+    if not groups:
+        return "Error while parsing request, check request syntax"
 
-    return "Error while parsing request, check request syntax" if result is None else result
+    return flask.Response(DB.stream_sessions(groups, begin, end),
+                          mimetype="application/x-ndjson")
 
 
-APP.run(host='0.0.0.0', port=8080)
+if __name__ == "__main__":
+    APP.run(host='0.0.0.0', port=8080)
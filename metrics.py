@@ -0,0 +1,203 @@
+"""
+    Collects the metrics of the API and exposes them in the Prometheus text format
+"""
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging.handlers
+import queue
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Registry:
+    """
+        Counters, gauges and histograms recorded from any thread. Recording only queues
+        the value, a background thread aggregates them.
+    """
+
+    def __init__(self):
+        """
+            Initializes an empty registry and starts its aggregating thread
+        """
+        # The kind, description and buckets of each metric, by name
+        self.kinds = {}
+        # The values of each metric by labels, a list of bucket counts then the sum
+        # and the count for histograms
+        self.values = {}
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.aggregate_forever, daemon=True).start()
+
+    def declare(self, name: str, kind: str, description: str, buckets: tuple = None):
+        """
+            Declares a metric, once per name
+        :param name: The name of the metric
+        :param kind: counter, gauge or histogram
+        :param description: The help text of the metric
+        :param buckets: The upper bounds of the buckets of a histogram
+        :return:
+            None
+        """
+        with self.lock:
+            if name not in self.kinds:
+                self.kinds[name] = (kind, description, buckets)
+                self.values[name] = {}
+
+    def observe(self, name: str, value: float, **labels):
+        """
+            Records a value in a histogram
+        :param name: The name of the histogram
+        :param value: The value
+        :param labels: The labels of the value
+        :return:
+            None
+        """
+        self.queue.put((name, value, labels, False))
+
+    def increment(self, name: str, value: float = 1.0, **labels):
+        """
+            Increments a counter
+        :param name: The name of the counter
+        :param value: The increment
+        :param labels: The labels of the counter
+        :return:
+            None
+        """
+        self.queue.put((name, value, labels, False))
+
+    def set(self, name: str, value: float, **labels):
+        """
+            Sets a gauge, or a counter to a total counted elsewhere
+        :param name: The name of the gauge or counter
+        :param value: The value
+        :param labels: The labels of the gauge or counter
+        :return:
+            None
+        """
+        self.queue.put((name, value, labels, True))
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+            Records the duration of a block in a histogram
+        :param name: The name of the histogram
+        :param labels: The labels of the duration
+        :return:
+            A context manager
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.queue.put((name, time.perf_counter() - start, labels, False))
+
+    def apply(self, name: str, value: float, labels: dict, replace: bool):
+        """
+            Aggregates a recorded value, the lock being held
+        :param name: The name of the metric
+        :param value: The value
+        :param labels: The labels of the value
+        :param replace: Whether the value replaces the current one of a counter or
+            gauge instead of being added to it
+        :return:
+            None
+        """
+        kind, _, buckets = self.kinds[name]
+        key = tuple(sorted(labels.items()))
+        values = self.values[name]
+        if kind != "histogram":
+            values[key] = value if replace else values.get(key, 0.0) + value
+        else:
+            if key not in values:
+                values[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            histogram = values[key]
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def drain(self):
+        """
+            Aggregates the queued values, the lock being held
+        :return:
+            None
+        """
+        while True:
+            try:
+                self.apply(*self.queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def aggregate_forever(self):
+        """
+            Aggregates the values as they are recorded
+        :return:
+            Never returns
+        """
+        while True:
+            item = self.queue.get()
+            with self.lock:
+                self.apply(*item)
+                self.drain()
+
+    def render(self):
+        """
+            Formats every metric in the Prometheus text exposition format
+        :return:
+            str
+        """
+        lines = []
+        with self.lock:
+            self.drain()
+            for name, (kind, description, buckets) in sorted(self.kinds.items()):
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for key, value in sorted(self.values[name].items()):
+                    if kind != "histogram":
+                        lines.append("{}{} {}".format(name, format_labels(key), value))
+                        continue
+                    cumulated = 0
+                    for bound, count in zip(buckets + ("+Inf",), value):
+                        cumulated += count
+                        lines.append("{}_bucket{} {}".format(
+                            name, format_labels(key + (("le", str(bound)),)), cumulated))
+                    lines.append("{}_sum{} {}".format(name, format_labels(key), value[-2]))
+                    lines.append("{}_count{} {}".format(name, format_labels(key), value[-1]))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: tuple):
+    """
+        Formats the labels of a value
+    :param labels: The (name, value) pairs of the labels
+    :return:
+        str, empty without labels
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels) + "}"
+
+
+def queue_handler(handler: logging.Handler):
+    """
+        Moves the writes of a log handler to a background thread, which writes the
+        remaining records when the process exits
+    :param handler: The handler writing the records, to a file for instance
+    :return:
+        A logging.handlers.QueueHandler to add to the logger instead
+    """
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return logging.handlers.QueueHandler(records)
+
+
+METRICS = Registry()
@@ -0,0 +1,71 @@
+"""
+    Keeps the database connections open between two requests
+"""
+from contextlib import contextmanager
+import os
+import threading
+
+
+class ConnectionPool:
+    """
+        A thread-safe pool of connections to a database file. The idle connections are
+        dropped when the file is replaced, so that they never read a stale database.
+    """
+
+    def __init__(self, factory, path: str, size: int = 8):
+        """
+            Initializes an empty pool
+        :param factory: The function opening a new connection, which can be used
+            from any thread
+        :param path: The path of the database file
+        :param size: The maximum number of idle connections kept open
+        """
+        self.factory = factory
+        self.path = path
+        self.size = size
+        self.idle = []
+        self.inode = None
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    @contextmanager
+    def connection(self):
+        """
+            Lends a connection, opening a new one if none is idle
+        :return:
+            A context manager giving a sqlite3.Connection
+        """
+        inode = os.stat(self.path).st_ino
+        connection = None
+        stale = []
+        with self.lock:
+            if inode != self.inode:
+                stale, self.idle = self.idle, []
+                self.inode = inode
+            if self.idle:
+                connection = self.idle.pop()
+        for old in stale:
+            old.close()
+        if connection is None:
+            connection = self.factory()
+            self.opened += 1
+        try:
+            yield connection
+        finally:
+            with self.lock:
+                keep = inode == self.inode and len(self.idle) < self.size
+                if keep:
+                    self.idle.append(connection)
+            if not keep:
+                connection.close()
+
+    def close(self):
+        """
+            Closes the idle connections
+        :return:
+            None
+        """
+        with self.lock:
+            stale, self.idle = self.idle, []
+        for connection in stale:
+            connection.close()
@@ -0,0 +1,43 @@
+"""
+    Refreshes the database from HyperPlanning apart from the web server,
+    which can then be served read-only by several processes
+
+    python3 refresher.py [--once] [--offline [--at "YYYY-MM-DD HH:MM:SS"]]
+"""
+import argparse
+from configparser import ConfigParser
+import databasemanager
+
+
+def main():
+    """
+        Builds the database once, or periodically until interrupted
+    :return:
+        None
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--once", action="store_true", help="Build the database once and exit")
+    parser.add_argument("--offline", action="store_true",
+                        help="Build the database once from the stored calendars and exit")
+    parser.add_argument("--at", metavar="MOMENT",
+                        help="With --offline, replay the calendars stored as of this time")
+    args = parser.parse_args()
+    if args.at and not args.offline:
+        parser.error("--at needs --offline")
+
+    config = ConfigParser()
+    config.read('config/database.config')
+    manager = databasemanager.from_config(config, serving=False)
+    if args.offline:
+        if manager.store is None:
+            parser.error("--offline needs a store in the [planning] section")
+        manager.build(offline=True, moment=args.at)
+    elif args.once:
+        manager.build()
+    else:
+        manager.refresh_forever(config.getfloat('planning', 'interval', fallback=3600.0),
+                                jitter=config.getfloat('planning', 'jitter', fallback=0.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+    Tests of the database built by DatabaseManager, run from the repository root :
+    python -m unittest discover tests
+"""
+from contextlib import closing
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+import databasemanager
+import hyperapi
+from benchmarks import get_sql, synthetic
+
+WEEKS = ["2020-W{:02d}".format(week) for week in range(2, 6)]
+
+
+def create_legacy(path: str, calendars: dict):
+    """
+        Creates a database the way the versions without schema version did, one
+        session per class and event, without UID nor fingerprint
+    :param path: The path of the database
+    :param calendars: The contents of the .ical files, by school class
+    :return:
+        None
+    """
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE sessions(id INTEGER PRIMARY KEY AUTOINCREMENT,' +
+                       'debut DATETIME NOT NULL, fin DATETIME NOT NULL, ' +
+                       'typeCours TEXT NOT NULL);')
+    databasemanager.create_tables(connection)
+    for school_class, text in calendars.items():
+        connection.execute('INSERT OR IGNORE INTO classes(nomClasse) VALUES (?);',
+                           (school_class,))
+        for session in hyperapi.parse(text):
+            if session.is_empty():
+                continue
+            session_id = connection.execute(
+                'INSERT INTO sessions(debut, fin, typeCours) VALUES (?, ?, ?);',
+                (session.dateDebut + " " + session.start_db,
+                 session.dateFin + " " + session.end_db, session.typeCours)).lastrowid
+            for table, column, key, values in (
+                    ("salles", "idSalle", "numeroSalle", session.numeroSalle.split(",")),
+                    ("profs", "idProf", "nomProf", session.nomProf.split(", "))):
+                for value in values:
+                    connection.execute('INSERT OR IGNORE INTO ' + table + '(' + key +
+                                       ') VALUES (?);', (value,))
+                    connection.execute(
+                        'INSERT INTO ' + ("lienSaSe" if table == "salles" else "lienPSe") +
+                        '(' + column + ', idSession) SELECT ' + column + ', ? FROM ' +
+                        table + ' WHERE ' + key + ' = ?;', (session_id, value))
+            connection.execute('INSERT OR IGNORE INTO cours(idMatiere, nomMatiere) ' +
+                               'VALUES (?, ?);', (session.idMatiere, session.nomMatiere))
+            connection.execute('INSERT INTO lienCoSe(idCours, idSession) SELECT idCours, ? ' +
+                               'FROM cours WHERE idMatiere = ? AND nomMatiere = ?;',
+                               (session_id, session.idMatiere, session.nomMatiere))
+            connection.execute('INSERT INTO lienClSe(idClasse, idSession) SELECT idClasse, ? ' +
+                               'FROM classes WHERE nomClasse = ?;', (session_id, school_class))
+    connection.commit()
+    connection.close()
+
+
+class QueryPlanTest(unittest.TestCase):
+    """
+        Checks that the queries of the requests stay fully indexed
+    """
+
+    def setUp(self):
+        """
+            Builds a small synthetic database
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        manager = databasemanager.DatabaseManager(
+            os.path.join(self.directory.name, "plannings.db"))
+        get_sql.populate(manager, 4, 4, 6)
+        self.connection = sqlite3.connect(manager.database)
+
+    def tearDown(self):
+        """
+            Removes the database
+        """
+        self.connection.close()
+        self.directory.cleanup()
+
+    def test_sessions_query(self):
+        self.assertEqual(databasemanager.explain(
+            self.connection, databasemanager.SESSIONS_QUERY,
+            ("G0",) + databasemanager.get_bounds(week="2020-W03")), [])
+
+    def test_bulk_query(self):
+        self.assertEqual(databasemanager.explain(
+            self.connection, databasemanager.bulk_query(2),
+            ("G0", "G1") + databasemanager.get_bounds(week="2020-W03")), [])
+
+    def test_changed_query(self):
+        self.assertEqual(databasemanager.explain(
+            self.connection, databasemanager.changed_query(2),
+            ("G0", "Cours-G0-0-0-1", "Cours-G0-0-0-2")), [])
+
+
+class BuildTest(unittest.TestCase):
+    """
+        Builds databases offline from synthetic calendars kept in a calendar store
+    """
+
+    def setUp(self):
+        """
+            Generates the calendars of two school classes sharing some sessions
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.calendars = {"G{}".format(index): synthetic.calendar(
+            "G{}".format(index), len(WEEKS) + 1, 4, seed=index) for index in range(2)}
+
+    def tearDown(self):
+        """
+            Removes the databases and the store
+        """
+        self.directory.cleanup()
+
+    def manager(self, name: str, store: str = "store", **kwargs):
+        """
+            Creates the DatabaseManager of a database whose calendars are stored
+        :param name: The file name of the database
+        :param store: The directory name of the calendar store
+        :param kwargs: The other arguments of the DatabaseManager
+        :return:
+            A DatabaseManager
+        """
+        manager = databasemanager.DatabaseManager(
+            os.path.join(self.directory.name, name),
+            store=os.path.join(self.directory.name, store), **kwargs)
+        manager.classes = [databasemanager.create_class(school_class, school_class)
+                           for school_class in self.calendars]
+        for school_class in manager.classes:
+            manager.store.save(school_class.url, self.calendars[school_class.nom],
+                               "2020-01-01 00:00:00")
+        return manager
+
+    def responses(self, manager: databasemanager.DatabaseManager):
+        """
+            Retrieves the responses of every school class over the calendar weeks
+        :param manager: The DatabaseManager of the database
+        :return:
+            A dict of the responses, by school class and week
+        """
+        return {(school_class, week): manager.get_sql(school_class, week=week)
+                for school_class in self.calendars for week in WEEKS}
+
+    def test_migrated_legacy_database(self):
+        path = os.path.join(self.directory.name, "legacy.db")
+        create_legacy(path, self.calendars)
+        legacy = self.manager("legacy.db")
+        legacy.build(offline=True)
+        fresh = self.manager("fresh.db")
+        fresh.build(offline=True)
+
+        self.assertEqual(self.responses(legacy), self.responses(fresh))
+        connection = sqlite3.connect(path)
+        self.assertEqual(connection.execute(
+            'SELECT COUNT(*) FROM sessions WHERE uid IS NULL;').fetchone()[0], 0)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM sessions;').fetchone(),
+                         sqlite3.connect(fresh.database).execute(
+                             'SELECT COUNT(*) FROM sessions;').fetchone())
+        connection.close()
+
+    def test_changes_since_unknown_generation(self):
+        manager = self.manager("plannings.db", history=2)
+        manager.build(offline=True)
+        self.assertEqual(manager.get_changes("G0", 1)["ajouts"], [])
+        self.assertIsNotNone(manager.get_changes("G0", 0))
+        self.assertIsNone(manager.get_changes("G0", 2))
+
+    def test_emptied_calendar_stays_materialized(self):
+        manager = self.manager("plannings.db", snapshots=True)
+        manager.build(offline=True)
+        manager.store.save(manager.classes[1].url, "BEGIN:VCALENDAR\nEND:VCALENDAR\n",
+                           "2020-01-02 00:00:00")
+        manager.build(offline=True)
+        generation = manager.get_state()["generation"]
+        manager.build(set())
+        self.assertEqual(manager.get_state()["generation"], generation)
+        self.assertEqual(manager.get_sql("G1", week=WEEKS[0]), "[]")
+
+    def test_unchanged_calendars_keep_generation(self):
+        manager = self.manager("plannings.db", snapshots=True)
+        manager.build(offline=True)
+        responses = self.responses(manager)
+        manager.build(offline=True)
+        self.assertEqual(manager.get_state()["generation"], 1)
+        self.assertEqual(self.responses(manager), responses)
+
+    def test_bad_calendar_does_not_stop_the_build(self):
+        # A course code without course name
+        self.calendars["G1"] = re.sub("SUMMARY:[^\\r\\n]*", "SUMMARY:M1234", self.calendars["G1"], 1)
+        manager = self.manager("plannings.db")
+        with self.assertLogs(databasemanager.LOGGER, "ERROR"):
+            failed = manager.build(offline=True)
+        self.assertEqual(failed, {manager.classes[1].url})
+        self.assertEqual(manager.get_state()["generation"], 1)
+        self.assertNotEqual(manager.get_sql("G0", week=WEEKS[0]), "[]")
+        self.assertEqual(manager.get_sql("G1", week=WEEKS[0]), "[]")
+
+    def test_unstorable_calendar_does_not_stop_the_build(self):
+        manager = self.manager("plannings.db")
+        sync_class = manager.sync_class
+
+        def failing(school_class, sessions_list, batch):
+            sync_class(school_class, sessions_list, batch)
+            if school_class == "G0":
+                raise AttributeError("unexpected event")
+        manager.sync_class = failing
+        with self.assertLogs(databasemanager.LOGGER, "ERROR"):
+            failed = manager.build(offline=True)
+        self.assertEqual(failed, {manager.classes[0].url})
+        fresh = self.manager("fresh.db")
+        del self.calendars["G0"]
+        fresh.classes = fresh.classes[1:]
+        fresh.build(offline=True)
+        self.assertEqual(self.responses(manager), self.responses(fresh))
+
+    def test_failed_refresh_is_not_verified(self):
+        manager = self.manager("plannings.db")
+        missing = databasemanager.create_class("G2", "G2")
+        manager.classes.append(missing)
+        with self.assertLogs(databasemanager.LOGGER, "ERROR"):
+            self.assertEqual(manager.build({missing.url}, offline=True), {missing.url})
+        self.assertIsNone(manager.get_state()["verification"])
+        with self.assertLogs(databasemanager.LOGGER, "ERROR"):
+            self.assertEqual(manager.build(offline=True), {missing.url})
+        self.assertIsNone(manager.get_state()["verification"])
+        manager.build({manager.classes[0].url}, offline=True)
+        self.assertIsNotNone(manager.get_state()["verification"])
+
+    def test_timetable_is_loaded_off_the_requests(self):
+        manager = self.manager("plannings.db", memory=True)
+        manager.build(offline=True)
+        self.assertEqual(manager.timetable.generation, manager.get_generation())
+        expected = {(school_class, week): manager.get_response(school_class, week=week)
+                    for school_class in self.calendars for week in WEEKS}
+
+        # Another process answers from the database until it loads the generation
+        reader = databasemanager.DatabaseManager(manager.database, memory=True, readonly=True)
+        self.assertEqual({(school_class, week): reader.get_response(school_class, week=week)
+                          for school_class in self.calendars for week in WEEKS}, expected)
+        self.assertIsNone(reader.timetable.generation)
+        reader.load()
+        self.assertEqual(reader.timetable.generation, reader.get_generation())
+        self.assertEqual({(school_class, week): reader.get_response(school_class, week=week)
+                          for school_class in self.calendars for week in WEEKS}, expected)
+
+    def test_process_pool_matches_serial_parsing(self):
+        serial = self.manager("serial.db", "serial", processes=1, snapshots=True)
+        serial.build(offline=True)
+        # A store of its own, so that the lessons parsed by the serial build are not reused
+        pooled = self.manager("pooled.db", "pooled", processes=2, snapshots=True)
+        pooled.build(offline=True)
+
+        self.assertEqual(self.responses(pooled), self.responses(serial))
+        for table in ("sessions", "lienClSe", "lienSaSe", "lienPSe", "lienCoSe", "snapshots"):
+            query = 'SELECT * FROM ' + table + ' ORDER BY 1, 2;'
+            with closing(sqlite3.connect(pooled.database)) as connection, \
+                    closing(sqlite3.connect(serial.database)) as reference:
+                self.assertEqual(connection.execute(query).fetchall(),
+                                 reference.execute(query).fetchall())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+    Tests of the parsing of the .ical files, run from the repository root :
+    python -m unittest discover tests
+"""
+import unittest
+import hyperapi
+from benchmarks import server
+
+# Lines of more than 75 octets are folded on the next line starting with a space
+FIXTURE = "\r\n".join([
+    "BEGIN:VCALENDAR",
+    "VERSION:2.0",
+    "PRODID:-//HyperAPI//Fixture//FR",
+    "BEGIN:VEVENT",
+    "UID:folded",
+    "DTSTAMP:20200101T000000Z",
+    "DTSTART:20200113T080000Z",
+    "DTEND:20200113T100000Z",
+    "SUMMARY:M3101 Matiere1 - M. Enseignant1, Mme Enseignant2, M. Enseignant3, Mme",
+    "  Enseignant4 - TD - G1",
+    "LOCATION:A1,B2",
+    "END:VEVENT",
+    "BEGIN:VEVENT",
+    "UID:alarm",
+    "DTSTAMP:20200101T000000Z",
+    "DTSTART:20200114T130000Z",
+    "DTEND:20200114T150000Z",
+    "SUMMARY:M3102 Matiere2 - Mme Enseignant5 - TP - G1",
+    "LOCATION:C3",
+    "BEGIN:VALARM",
+    "ACTION:DISPLAY",
+    "DESCRIPTION:Rappel",
+    "TRIGGER:-PT15M",
+    "END:VALARM",
+    "END:VEVENT",
+    "BEGIN:VEVENT",
+    "UID:allday",
+    "DTSTAMP:20200101T000000Z",
+    "DTSTART;VALUE=DATE:20200115",
+    "DTEND;VALUE=DATE:20200116",
+    "SUMMARY:Journee banalisee",
+    "END:VEVENT",
+    "BEGIN:VEVENT",
+    "UID:ds",
+    "DTSTAMP:20200101T000000Z",
+    "DTSTART:20200406T070000Z",
+    "DTEND:20200406T090000Z",
+    "SUMMARY:M3103 Matiere3 - M. Enseignant6 - DS - Controle 3 - G1",
+    "LOCATION:B4",
+    "END:VEVENT",
+    "END:VCALENDAR",
+    ""])
+
+
+class ParseTest(unittest.TestCase):
+    """
+        Checks that the calendars give the same lessons whether they are parsed whole,
+        line by line or while being downloaded
+    """
+
+    def setUp(self):
+        """
+            Serves the fixture calendar
+        """
+        self.server = server.serve({"fixture": FIXTURE})
+        self.url = "http://127.0.0.1:{}/?idICal=fixture".format(self.server.server_port)
+
+    def tearDown(self):
+        """
+            Stops the server
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_parsers_agree(self):
+        lessons = hyperapi.parse(FIXTURE)
+        expected = [lesson.as_tuple() for lesson in lessons]
+        self.assertEqual(expected, [lesson.as_tuple() for lesson in
+                                    hyperapi.parse_lines(FIXTURE.splitlines())])
+        self.assertEqual(expected, [lesson.as_tuple() for lesson in
+                                    hyperapi.scrape_stream(self.url)])
+        self.assertEqual(expected, [lesson.as_tuple() for lesson in hyperapi.scrape(self.url)])
+
+        folded, alarm, allday, ds = lessons
+        self.assertEqual("M. Enseignant1, Mme Enseignant2, M. Enseignant3, Mme Enseignant4",
+                         folded.nomProf)
+        self.assertEqual(("14h00", "16h00"), (alarm.heureDebut, alarm.heureFin))
+        self.assertEqual(("2020-01-15", "Heure inconnue"), (allday.dateDebut, allday.heureDebut))
+        self.assertEqual(("DS", "Matiere3 : Controle 3", "09h00"),
+                         (ds.typeCours, ds.nomMatiere, ds.heureDebut))
+
+
+if __name__ == '__main__':
+    unittest.main()
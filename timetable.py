@@ -0,0 +1,71 @@
+"""
+    Serves the timetables from memory, without querying the database
+"""
+from array import array
+from bisect import bisect_left
+import threading
+
+
+class Timetable:
+    """
+        The lessons of every class of a database generation, held in columns sorted by
+        class then start time : the start times in minutes since the epoch and the
+        lessons already encoded as JSON, with the range of rows of each class
+    """
+
+    def __init__(self):
+        """
+            Initializes an empty timetable
+        """
+        self.generation = None
+        # (starts, lessons, offsets), replaced as a whole by each load
+        self.columns = (array('q'), [], {})
+        self.lock = threading.Lock()
+
+    def refresh(self, generation: int, loader):
+        """
+            Loads the lessons of a generation if they are not loaded yet
+        :param generation: The current generation of the database
+        :param loader: The function listing the (school class, start, lesson) of the
+            generation, sorted by school class then start
+        :return:
+            None
+        """
+        if generation == self.generation:
+            return
+        with self.lock:
+            if generation == self.generation:
+                return
+            starts = array('q')
+            lessons = []
+            offsets = {}
+            for school_class, start, lesson in loader():
+                if school_class not in offsets:
+                    offsets[school_class] = [len(lessons), len(lessons)]
+                offsets[school_class][1] += 1
+                starts.append(start)
+                lessons.append(lesson)
+            self.columns = (starts, lessons, offsets)
+            self.generation = generation
+
+    def lookup(self, school_class: str, begin: int, end: int):
+        """
+            Lists the lessons of a school class starting in a time range
+        :param school_class: The desired school class
+        :param begin: The start of the range, in minutes since the epoch
+        :param end: The excluded end of the range, in minutes since the epoch
+        :return:
+            A list of JSON lessons
+        """
+        starts, lessons, offsets = self.columns
+        first, last = offsets.get(school_class, (0, 0))
+        return lessons[bisect_left(starts, begin, first, last):
+                       bisect_left(starts, end, first, last)]
+
+    def __len__(self):
+        """
+            Counts the loaded lessons
+        :return:
+            int
+        """
+        return len(self.columns[1])